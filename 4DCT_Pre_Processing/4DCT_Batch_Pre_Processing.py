@@ -0,0 +1,32 @@
+"""
+@author: Kyriakos Fotiou
+"""
+import matplotlib
+# Batch mode never plots, a non-interactive backend keeps the workers from opening windows
+matplotlib.use('Agg')
+from Functions_Pre_Processing import run_batch_pre_processing
+
+if __name__ == '__main__':
+    """
+    Batch Pre-processing
+    """
+    ## Manifest of the cohort: a CSV with the columns patient,data_dir[,calibration], e.g.
+    ## p104,/data/cohort/p104,default
+    ## data_dir holds the CT_<patient>, tumor_<patient>, heart_<patient>, cord_<patient>,
+    ## rlung_<patient> and llung_<patient> directories of the patient.
+    manifest = 'patients.csv'
+    ## Each patient's volume container is written to <output_root>/<patient>/<patient>_volumes
+    output_root = 'Pre_Processed'
+    ## Maximum number of patients processed at once. None uses all CPUs; the number is
+    ## further limited so the estimated memory of the running patients fits in memory.
+    workers = None
+    ## True re-processes patients whose outputs are already up to date
+    force = False
+
+    status = run_batch_pre_processing(manifest, output_root, workers, force=force)
+    failed = [patient for patient, result, seconds in status if result.startswith('failed')]
+    print('{} patients processed, {} up to date, {} failed'.format(
+        sum(result == 'processed' for patient, result, seconds in status),
+        sum(result == 'up to date' for patient, result, seconds in status), len(failed)))
+    if failed:
+        print('failed patients: ' + ', '.join(failed))
@@ -2,9 +2,14 @@
 @author: Kyriakos Fotiou
 """
 import os  
+import csv
+import re
+import json
+import time
 import numpy as np
 import matplotlib.pyplot as plt 
 from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 def generate_oar_maps(oar_list):
     """
@@ -13,12 +18,25 @@ def generate_oar_maps(oar_list):
     oar_list : A list of Arrays containign CT in numpy array format 
     Returns
     -------
-    oar : Array depicting the composite of all organ contours from the 4D CT scan.
+    oar : Boolean array depicting the composite of all organ contours from the 4D CT scan.
     """
-    print('Generate OAR map')
-    oar = np.sum(oar_list, axis = 0)
-    oar[oar>=1]=1
-    return oar
+    return union_masks(oar_list)
+
+
+def union_masks(mask_list):
+    """
+    Parameters
+    ----------
+    mask_list : A list of contour arrays, or a (phases, Z, Y, X) array
+    Returns
+    -------
+    union : Boolean array of the voxels inside any of the contours, reduced in place 
+            without summing the contours into a wide integer array.
+    """
+    union = np.zeros(np.shape(mask_list[0]), dtype=bool)
+    for mask in mask_list:
+        np.logical_or(union, mask, out=union)
+    return union
 
 
 def generate_ct_maps(ct_array):
@@ -28,12 +46,12 @@ def generate_ct_maps(ct_array):
     ct_array : A list of Arrays containign CT in numpy array format 
     Returns
     -------
-    AIP_ct : The average attenuation of each voxel is displayed.
+    AIP_ct : The average attenuation of each voxel is displayed (float32).
     MIP_ct : The voxel with the highest attenuation is displayed.
     MinIP_ct : The voxel with the lowest attenuation is displayed.
     """
     # calculate the average CT
-    AIP_ct = np.mean(ct_array, axis=0)
+    AIP_ct = np.mean(ct_array, axis=0, dtype=np.float32)
     # calculate MIP CT
     MIP_ct = np.amax(ct_array, axis=0)
     #Calculate MinIP CT
@@ -50,23 +68,18 @@ def generate_itv_ctv_ictv(tumor_list, voxel_size, expansion_magnitude):
     expansion_magnitude : Magnitude of expansion of the tumour in mm.
     Returns
     -------
-    ctv_list : A list of Arrays containign expanded tumor coordinates.
-    ictv : Array depicting the composite of all CTV controus.
+    ctv_list : A list of boolean Arrays containign expanded tumor coordinates.
+    ictv : Boolean array depicting the composite of all CTV controus.
     """
-    print('generate ctv')
     ctv_list =[]
     #Generate ITV
-    itv = np.sum(tumor_list, axis=0)
-    itv[itv>=1]=1
+    itv = union_masks(tumor_list)
     #Generate CTV and iCTV
-    i= 0
     for tumor in tumor_list:
-        i = i +1
-        print(i)
         # Calculate the dilation radius for the x-y plane only
         dilation_radius = tuple(expansion_magnitude / np.array(voxel_size))
-        new_array = np.zeros_like(tumor)
-        ctv = np.zeros_like(tumor)
+        new_array = np.zeros(np.shape(tumor), dtype=bool)
+        ctv = np.zeros(np.shape(tumor), dtype=bool)
         # Find the tumor indices
         tumor_indices = np.argwhere(tumor)
         # Get the min and max indices for the tumor in the z-axis
@@ -87,11 +100,165 @@ def generate_itv_ctv_ictv(tumor_list, voxel_size, expansion_magnitude):
         dilated_array_z = ndimage.binary_dilation(new_array, structure= np.ones(shape=(3,1,1),dtype=float), iterations=int(np.floor(dilation_radius[0])))
         ctv[:,:,:] =  dilated_array_z
         ctv_list.append(ctv)
-    ictv = np.sum(ctv_list, axis=0)
-    ictv[ictv>=1]=1
+    ictv = union_masks(ctv_list)
 
     return itv,ctv_list, ictv
 
+def margin_bounding_box(tumor, voxel_size, expansion_magnitude):
+    """
+    Parameters
+    ----------
+    tumor : Array containign tumor coordinates, or any other contour (e.g. the body)
+    voxel_size : Voxel dimensions of the CT scan
+    expansion_magnitude : Margin around the contour in mm.
+    Returns
+    -------
+    box : Tuple of slices of the contour bounding box padded by the margin, or None if the 
+          contour is empty.
+    """
+    tumor_indices = np.argwhere(tumor)
+    if len(tumor_indices) == 0:
+        return None
+    padding = np.ceil(expansion_magnitude / np.asarray(voxel_size)).astype(int) + 1
+    lower = np.maximum(tumor_indices.min(axis=0) - padding, 0)
+    upper = np.minimum(tumor_indices.max(axis=0) + padding + 1, tumor.shape)
+    return tuple(slice(int(low), int(up)) for low, up in zip(lower, upper))
+
+
+def expand_margin(tumor, voxel_size, expansion_magnitude):
+    """
+    Exact millimetre margin expansion: every voxel whose centre lies within 
+    expansion_magnitude of a tumour voxel centre, from a Euclidean distance transform 
+    sampled with the voxel dimensions and restricted to the padded tumour bounding box.
+    Parameters
+    ----------
+    tumor : Array containign tumor coordinates
+    voxel_size : Voxel dimensions of the CT scan
+    expansion_magnitude : Magnitude of expansion of the tumour in mm.
+    Returns
+    -------
+    ctv : Boolean array of the expanded tumour.
+    """
+    ctv = np.zeros(np.shape(tumor), dtype=bool)
+    box = margin_bounding_box(tumor, voxel_size, expansion_magnitude)
+    if box is not None:
+        ctv[box] = _expand_margin_box(np.asarray(tumor)[box], voxel_size, expansion_magnitude)
+    return ctv
+
+
+def _expand_margin_box(tumor_box, voxel_size, expansion_magnitude):
+    distance = ndimage.distance_transform_edt(tumor_box == 0, sampling=voxel_size)
+    return distance <= expansion_magnitude
+
+
+def generate_itv_ctv_ictv_edt(tumor_list, voxel_size, expansion_magnitude, workers=None):
+    """
+    Parameters
+    ----------
+    tumor_list : A list of Arrays containign tumor coordinates in numpy array format
+    voxel_size : Voxel dimensions of the CT scan
+    expansion_magnitude : Magnitude of expansion of the tumour in mm.
+    workers : Number of worker processes expanding the phases in parallel. None uses all 
+              CPUs; 1 expands the phases serially.
+    Returns
+    -------
+    itv : Boolean array depicting the composite of all GTV contours.
+    ctv_list : A list of boolean Arrays containign expanded tumor coordinates.
+    ictv : Boolean array depicting the composite of all CTV controus.
+    """
+    itv = union_masks(tumor_list)
+    # Only the padded bounding box of each GTV is sent to the workers
+    boxes = [margin_bounding_box(tumor, voxel_size, expansion_magnitude) for tumor in tumor_list]
+    tumor_boxes = [np.asarray(tumor)[box] for tumor, box in zip(tumor_list, boxes) if box is not None]
+    arguments = (tumor_boxes, [voxel_size] * len(tumor_boxes), [expansion_magnitude] * len(tumor_boxes))
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1:
+        ctv_boxes = list(map(_expand_margin_box, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            ctv_boxes = list(executor.map(_expand_margin_box, *arguments))
+    ctv_boxes = iter(ctv_boxes)
+    ctv_list = []
+    ictv = np.zeros_like(itv)
+    for box in boxes:
+        ctv = np.zeros_like(itv)
+        if box is not None:
+            ctv[box] = next(ctv_boxes)
+        ictv |= ctv
+        ctv_list.append(ctv)
+    return itv, ctv_list, ictv
+
+
+def compare_margin_expansion(tumor_list, voxel_size, expansion_magnitude):
+    """
+    Parameters
+    ----------
+    tumor_list : A list of Arrays containign tumor coordinates in numpy array format
+    voxel_size : Voxel dimensions of the CT scan
+    expansion_magnitude : Magnitude of expansion of the tumour in mm.
+    Returns
+    -------
+    report : Dictionary comparing the iCTV of the distance-transform expansion with the legacy 
+             dilation: volumes in cm^3, voxels only in either one, and the Dice coefficient.
+    """
+    _, _, ictv_legacy = generate_itv_ctv_ictv(tumor_list, voxel_size, expansion_magnitude)
+    _, _, ictv_edt = generate_itv_ctv_ictv_edt(tumor_list, voxel_size, expansion_magnitude, workers=1)
+    ictv_legacy = ictv_legacy >= 1
+    voxel_volume = np.prod(voxel_size) / 1000
+    overlap = np.count_nonzero(ictv_legacy & ictv_edt)
+    report = {'legacy_volume_cc': np.count_nonzero(ictv_legacy) * voxel_volume,
+              'edt_volume_cc': np.count_nonzero(ictv_edt) * voxel_volume,
+              'legacy_only_voxels': np.count_nonzero(ictv_legacy & ~ictv_edt),
+              'edt_only_voxels': np.count_nonzero(ictv_edt & ~ictv_legacy),
+              'dice': 2 * overlap / (np.count_nonzero(ictv_legacy) + np.count_nonzero(ictv_edt))}
+    return report
+
+
+def segment_body(ct, threshold=-500, opening_iterations=2):
+    """
+    Segments the external body contour from a HU CT scan (e.g. the AIP): voxels above 
+    the threshold are opened in the transverse plane to detach the couch, the largest 
+    connected component is kept and the holes (lungs, airways) are filled slice by slice.
+    Parameters
+    ----------
+    ct : CT array in HU
+    threshold : HU above which a voxel is considered tissue
+    opening_iterations : Number of in-plane openings used to separate the couch from the body
+    Returns
+    -------
+    body : Boolean array of the patient's body.
+    """
+    in_plane = np.zeros((3, 3, 3), dtype=bool)
+    in_plane[1] = ndimage.generate_binary_structure(2, 1)
+    body = np.asarray(ct) > threshold
+    if opening_iterations:
+        body = ndimage.binary_opening(body, structure=in_plane, iterations=opening_iterations)
+    labels, n_labels = ndimage.label(body)
+    if n_labels == 0:
+        raise ValueError('No voxels above {} HU, the body outline can not be segmented'.format(threshold))
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    body = labels == np.argmax(sizes)
+    return ndimage.binary_fill_holes(body, structure=in_plane)
+
+
+def crop_to_box(array, box):
+    """
+    Parameters
+    ----------
+    array : 3D array, a (phases, Z, Y, X) array or a list of 3D arrays
+    box : Tuple of three slices over the (Z, Y, X) axes, e.g. from margin_bounding_box of the body
+    Returns
+    -------
+    cropped : The array (or list of arrays) cropped to the box. Cropped arrays are copies, 
+              so the full size arrays can be released.
+    """
+    if isinstance(array, (list, tuple)):
+        return [crop_to_box(phase_array, box) for phase_array in array]
+    return np.array(np.asarray(array)[(Ellipsis,) + tuple(box)])
+
+
 def crop_oar (oar,tumour):
     """
     Parameters
@@ -100,40 +267,728 @@ def crop_oar (oar,tumour):
     tumour : Tumour volume that the OAR will be cropped at
     Returns
     -------
-    oar_cropped : Cropped OAR array
+    oar_cropped : Cropped boolean OAR array
     """
-    oar_cropped= np.where(oar >0.1,1,tumour)
+    oar_cropped = np.greater(oar, 0.1)
+    np.logical_or(oar_cropped, tumour, out=oar_cropped)
     return oar_cropped
 
 
-def transform_HU_to_RSP(ct_array):
+class HUToRSPCalibration:
+    """
+    Piecewise-linear HU to RSP calibration curve of a CT scanner. Segment n applies 
+    RSP = HU * slopes[n] + intercepts[n] for upper_bounds[n-1] < HU <= upper_bounds[n]; 
+    the last upper bound is inf.
+    Parameters
+    ----------
+    upper_bounds : Inclusive upper HU bound of every segment
+    slopes : Slope of every segment
+    intercepts : Intercept of every segment
+    name : Name of the curve, e.g. the scanner
+    """
+
+    def __init__(self, upper_bounds, slopes, intercepts, name=None):
+        self.upper_bounds = np.asarray(upper_bounds, dtype=float)
+        self.slopes = np.asarray(slopes, dtype=float)
+        self.intercepts = np.asarray(intercepts, dtype=float)
+        self.name = name
+        if not (len(self.upper_bounds) == len(self.slopes) == len(self.intercepts)) \
+                or self.upper_bounds[-1] != np.inf or np.any(np.diff(self.upper_bounds) <= 0):
+            raise ValueError('Calibration segments must have increasing upper bounds ending in inf')
+        self._lookup_table = None
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Parameters
+        ----------
+        path : CSV file with a header and one 'hu_upper,slope,intercept' row per segment
+        Returns
+        -------
+        calibration : HUToRSPCalibration of the curve.
+        """
+        curve = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+        name = os.path.splitext(os.path.basename(path))[0]
+        return cls(curve[:, 0], curve[:, 1], curve[:, 2], name)
+
+    def lookup_table(self):
+        """
+        RSP of every int16 HU value, indexed by the HU value reinterpreted as uint16.
+        """
+        if self._lookup_table is None:
+            hu = np.arange(2**16)
+            hu = np.where(hu >= 2**15, hu - 2**16, hu).astype(np.float64)
+            segment = np.searchsorted(self.upper_bounds, hu, side='left')
+            self._lookup_table = (hu * self.slopes[segment] + self.intercepts[segment]).astype(np.float32)
+        return self._lookup_table
+
+    def convert(self, array, out=None, chunk_size=2**16):
+        """
+        int16 input is gathered from the lookup table. Other dtypes are evaluated with 
+        the piecewise formula itself, chunk_size voxels at a time so the buffers stay 
+        small: the segment of a voxel is the number of upper bounds below its HU (the 
+        left-sided searchsorted index, counted with one comparison per bound, which is 
+        faster than a binary search for a handful of segments) and 
+        RSP = HU * slopes[segment] + intercepts[segment] is computed in float64.
+        Parameters
+        ----------
+        array : CT array in HU
+        out : Optional preallocated float32 output array; may be array itself for an 
+              in-place conversion of a float32 CT
+        chunk_size : Number of voxels evaluated at a time for non-int16 input
+        Returns
+        -------
+        rsp : The CT transformed from HU to RSP.
+        """
+        array = np.asarray(array)
+        if out is None:
+            out = np.empty(array.shape, dtype=np.float32)
+        if array.dtype == np.int16:
+            # Integer HU: a single gather from the precompiled lookup table
+            np.take(self.lookup_table(), array.view(np.uint16), mode='clip', out=out)
+            return out
+        flat_array = array.reshape(-1)
+        flat_out = out.reshape(-1) if out.flags.c_contiguous else np.empty(out.size, dtype=np.float32)
+        chunk_size = max(1, min(chunk_size, flat_array.size))
+        hu = np.empty(chunk_size, dtype=np.float64)
+        segment = np.empty(chunk_size, dtype=np.intp)
+        above = np.empty(chunk_size, dtype=bool)
+        rsp = np.empty(chunk_size, dtype=np.float64)
+        for start in range(0, flat_array.size, chunk_size):
+            stop = min(start + chunk_size, flat_array.size)
+            count = stop - start
+            # The chunk is read into the buffers before out is written, so out may alias array
+            np.copyto(hu[:count], flat_array[start:stop], casting='unsafe')
+            segment[:count] = 0
+            for bound in self.upper_bounds[:-1]:
+                np.greater(hu[:count], bound, out=above[:count])
+                np.add(segment[:count], above[:count], out=segment[:count])
+            np.take(self.slopes, segment[:count], out=rsp[:count])
+            np.multiply(rsp[:count], hu[:count], out=rsp[:count])
+            np.add(rsp[:count], np.take(self.intercepts, segment[:count]), out=rsp[:count])
+            np.copyto(flat_out[start:stop], rsp[:count], casting='same_kind')
+        if not out.flags.c_contiguous:
+            out[...] = flat_out.reshape(out.shape)
+        return out
+
+def load_calibration(curve='default'):
+    """
+    Parameters
+    ----------
+    curve : Name of a curve in the Calibration_Curves folder (e.g. the scanner used for 
+            the patient) or path to a calibration CSV file
+    Returns
+    -------
+    calibration : HUToRSPCalibration of the curve.
+    """
+    return HUToRSPCalibration.from_file(calibration_path(curve))
+
+
+def calibration_path(curve='default'):
+    """
+    Parameters
+    ----------
+    curve : Name of a curve in the Calibration_Curves folder or path to a calibration CSV file
+    Returns
+    -------
+    path : Path of the calibration CSV file.
+    """
+    if os.path.isfile(curve):
+        return curve
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Calibration_Curves', curve + '.csv')
+
+
+def transform_HU_to_RSP(ct_array, calibration=None):
     """
     Parameters
     ----------
     ct_array : A list of Arrays containign CT in numpy array format 
+    calibration : HUToRSPCalibration of the scanner. Defaults to the 'default' curve.
     Returns
     -------
     RSP_ct_array: A list of Arrays containign the transformed CT from HU to RSP values 
 
     """
+    if calibration is None:
+        calibration = load_calibration()
     RSP_ct_array = []
     for array in ct_array:
-        new_array = array.copy()
-        print("RSP_eval:")
-        new_array[array > 40] = new_array[array > 40]*0.000976438425349501+ 1.01685572002769
-        new_array[(array > 20) & (array <= 40)] = new_array[(array > 20) & (array <= 40)]*0.00102118905637142 + 1.01596070740725
-        new_array[array <= 20] = new_array[array <= 20]*0.000694191199870186 + 1.0290406216673
-        RSP_ct_array.append(new_array)
+        RSP_ct_array.append(calibration.convert(array))
     return RSP_ct_array
 
 
-def transform_Single_CT_HU_to_RSP(array):
-    new_array = array.copy()
-    print("RSP_ref:")
-    new_array[array > 40] = new_array[array > 40]*0.000976438425349501+ 1.01685572002769
-    new_array[(array > 20) & (array <= 40)] = new_array[(array > 20) & (array <= 40)]*0.00102118905637142 + 1.01596070740725
-    new_array[array <= 20] = new_array[array <= 20]*0.000694191199870186 + 1.0290406216673
+def transform_Single_CT_HU_to_RSP(array, calibration=None, out=None):
+    """
+    Parameters
+    ----------
+    array : CT array in HU
+    calibration : HUToRSPCalibration of the scanner. Defaults to the 'default' curve.
+    out : Optional preallocated float32 output array
+    Returns
+    -------
+    new_array : The CT transformed from HU to RSP values.
+    """
+    if calibration is None:
+        calibration = load_calibration()
+    new_array = calibration.convert(array, out)
     return new_array
 
 
+class VolumeContainerWriter:
+    """
+    Writes the volumes of a patient into a single container: a directory holding one .npy 
+    file per named array and a metadata.json with the dtypes, shapes and grid (spacing and 
+    origin). The arrays can then be opened memory-mapped, see open_volume_container in the 
+    angle selection functions. RSP volumes ('volume') are stored as float32, HU CT scans 
+    ('hu') as int16 and contours ('mask') as bit-packed bool, one bit per voxel on disk.
+    Parameters
+    ----------
+    path : Directory of the container
+    voxel_size : Voxel dimensions of the CT scan
+    origin : Position of the first voxel
+    """
+
+    dtypes = {'volume': np.float32, 'hu': np.int16, 'mask': bool}
+
+    def __init__(self, path, voxel_size, origin=(0.0, 0.0, 0.0)):
+        os.makedirs(path, exist_ok=True)
+        # metadata.json is only written by close, so a stale one must not outlive a rewrite
+        if os.path.isfile(os.path.join(path, 'metadata.json')):
+            os.remove(os.path.join(path, 'metadata.json'))
+        self.path = path
+        self.metadata = {'version': 2,
+                         'voxel_size': [float(size) for size in voxel_size],
+                         'origin': [float(position) for position in origin],
+                         'arrays': {}}
+        self._arrays = {}
+
+    def allocate(self, name, shape, kind='volume'):
+        """
+        Parameters
+        ----------
+        name : Name of the array
+        shape : Shape of the array
+        kind : 'volume' or 'hu'. Masks are bit-packed and can only be stored with add.
+        Returns
+        -------
+        stored : Writable memory-mapped array in the container, to be filled in place.
+        """
+        if kind == 'mask':
+            raise ValueError('Masks are stored bit-packed, use add instead of allocate')
+        filename = name + '.npy'
+        stored = np.lib.format.open_memmap(os.path.join(self.path, filename), mode='w+', 
+                                           dtype=self.dtypes[kind], shape=tuple(shape))
+        self._arrays[name] = stored
+        self.metadata['arrays'][name] = {'file': filename, 'kind': kind, 
+                                         'dtype': np.dtype(self.dtypes[kind]).name, 'shape': list(shape)}
+        return stored
+
+    def add(self, name, array, kind='volume'):
+        """
+        Parameters
+        ----------
+        name : Name of the array
+        array : Array to store. A list of arrays (e.g. the 4DCT phases) is stored as one 
+                (phases, Z, Y, X) array, written phase by phase so it is never stacked in memory.
+        kind : 'volume', 'hu' or 'mask'
+        """
+        if kind == 'mask':
+            # Non-zero voxels are inside the contour; eight voxels per byte on disk
+            mask = np.not_equal(array, 0)
+            filename = name + '.npy'
+            np.save(os.path.join(self.path, filename), np.packbits(mask))
+            self.metadata['arrays'][name] = {'file': filename, 'kind': kind, 'dtype': 'bool', 
+                                             'shape': list(mask.shape), 'packed': True}
+            return
+        if kind == 'hu':
+            # Projections such as the AIP are rounded to whole HU
+            array = [np.rint(phase_array) for phase_array in array] if isinstance(array, (list, tuple)) else np.rint(array)
+        if isinstance(array, (list, tuple)):
+            stored = self.allocate(name, (len(array),) + np.shape(array[0]), kind)
+            for phase, phase_array in enumerate(array):
+                stored[phase] = phase_array
+        else:
+            stored = self.allocate(name, np.shape(array), kind)
+            stored[...] = array
+
+    def crop(self, box, original_shape):
+        """
+        Crops every array already in the container to box (e.g. the body bounding box) and 
+        records the offset and original shape in the metadata, so cropped results can be 
+        mapped back to the original CT grid. Arrays added afterwards must already be cropped. 
+        The arrays returned by allocate must be released before the crop, their full size 
+        files are deleted.
+        Parameters
+        ----------
+        box : Tuple of three slices over the (Z, Y, X) axes
+        original_shape : (Z, Y, X) shape of the CT grid before cropping
+        Returns
+        -------
+        cropped : Dictionary of name to the cropped memory-mapped arrays, replacing the arrays 
+                  returned by allocate.
+        """
+        offset = [int(axis.start) for axis in box]
+        cropped = {}
+        for name in list(self._arrays):
+            stored = self._arrays.pop(name)
+            info = self.metadata['arrays'][name]
+            # The cropped array is written to a new file and metadata.json points at it, so 
+            # the full size file is never replaced while it is memory-mapped (Windows refuses)
+            filename = name + ('.cropped.npy' if info['file'] == name + '.npy' else '.npy')
+            shape = stored.shape[:-3] + tuple(int(axis.stop - axis.start) for axis in box)
+            new_stored = np.lib.format.open_memmap(os.path.join(self.path, filename), mode='w+', 
+                                                   dtype=stored.dtype, shape=shape)
+            for index in np.ndindex(stored.shape[:-3]):
+                new_stored[index] = stored[index][box]
+            new_stored.flush()
+            del stored
+            try:
+                os.remove(os.path.join(self.path, info['file']))
+            except PermissionError:
+                # Still mapped by a reference held by the caller; no longer part of the container
+                pass
+            self._arrays[name] = cropped[name] = new_stored
+            info['file'] = filename
+            info['shape'] = list(shape)
+        self.metadata['origin'] = [position + start * size for position, start, size 
+                                   in zip(self.metadata['origin'], offset, self.metadata['voxel_size'])]
+        self.metadata['crop'] = {'offset': offset, 'original_shape': [int(size) for size in original_shape]}
+        return cropped
+
+    def close(self):
+        for stored in self._arrays.values():
+            stored.flush()
+        self._arrays = {}
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def save_volume_container(path, volumes, masks, voxel_size, origin=(0.0, 0.0, 0.0)):
+    """
+    Parameters
+    ----------
+    path : Directory of the container, see VolumeContainerWriter
+    volumes : Dictionary of name to CT/RSP array, stored as float32. A list of arrays 
+              (e.g. the 4DCT phases) is stored as one (phases, Z, Y, X) array.
+    masks : Dictionary of name to contour array, stored bit-packed
+    voxel_size : Voxel dimensions of the CT scan
+    origin : Position of the first voxel
+    Returns
+    -------
+    None.
+    """
+    with VolumeContainerWriter(path, voxel_size, origin) as container:
+        for name, array in volumes.items():
+            container.add(name, array, 'volume')
+        for name, array in masks.items():
+            container.add(name, array, 'mask')
+
+
+def stream_ct_maps(phase_paths, rsp_output=None, calibration=None):
+    """
+    Single pass over the 4DCT that reads one phase at a time from disk, updates running 
+    mean, maximum and minimum accumulators and converts each phase to RSP as it goes, so 
+    peak memory is of the order of two phases (the current one and the one being read 
+    ahead) rather than all phases.
+    Parameters
+    ----------
+    phase_paths : List of .npy files, one per 4DCT phase, in phase order (see phase_files)
+    rsp_output : Optional (phases, Z, Y, X) array (e.g. from VolumeContainerWriter.allocate) 
+                 that receives the RSP conversion of every phase
+    calibration : HUToRSPCalibration of the scanner. Defaults to the 'default' curve.
+    Returns
+    -------
+    AIP_ct : The average attenuation of each voxel is displayed.
+    MIP_ct : The voxel with the highest attenuation is displayed.
+    MinIP_ct : The voxel with the lowest attenuation is displayed.
+    """
+    # The next phase is read on a background thread while the current one is processed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_ct = executor.submit(np.load, phase_paths[0])
+        for phase in range(len(phase_paths)):
+            ct = next_ct.result()
+            if phase + 1 < len(phase_paths):
+                next_ct = executor.submit(np.load, phase_paths[phase + 1])
+            if phase == 0:
+                # float32 sums of int16 HU are exact for up to 512 phases
+                sum_ct = ct.astype(np.float32)
+                MIP_ct = ct.copy()
+                MinIP_ct = ct.copy()
+            else:
+                sum_ct += ct
+                np.maximum(MIP_ct, ct, out=MIP_ct)
+                np.minimum(MinIP_ct, ct, out=MinIP_ct)
+            if rsp_output is not None:
+                transform_Single_CT_HU_to_RSP(ct, calibration, out=rsp_output[phase])
+            del ct
+    sum_ct /= len(phase_paths)
+    AIP_ct = sum_ct
+    return AIP_ct, MIP_ct ,MinIP_ct
+
+
+## Structure directories of a patient, named <structure>_<patient> (e.g. tumor_p104)
+structure_directories = {'ct': 'CT', 'tumor': 'tumor', 'heart': 'heart', 'cord': 'cord',
+                         'rlung': 'rlung', 'llung': 'llung'}
+
+
+def patient_directories(patient, data_dir='.'):
+    """
+    Parameters
+    ----------
+    patient : Patient identifier, e.g. 'p104'
+    data_dir : Directory holding the CT_<patient>, tumor_<patient>, ... directories
+    Returns
+    -------
+    directories : Dictionary of structure name to the directory of its phase arrays.
+    """
+    return {name: os.path.join(data_dir, prefix + '_' + patient) for name, prefix in structure_directories.items()}
+
+
+def phase_index(filename):
+    """
+    Parameters
+    ----------
+    filename : File name of a phase array, e.g. 'CT_phase_10.npy'
+    Returns
+    -------
+    index : The phase index, the last integer in the file name.
+    """
+    numbers = re.findall(r'\d+', os.path.splitext(os.path.basename(filename))[0])
+    if not numbers:
+        raise ValueError('No phase index in the file name "{}"'.format(filename))
+    return int(numbers[-1])
+
+
+def phase_files(dirname, ext='.npy'):
+    """
+    Parameters
+    ----------
+    dirname : Directory with one array per 4DCT phase
+    ext : File extension of the arrays
+    Returns
+    -------
+    phase_paths : A list of the array files sorted by the phase index in their names, so 
+                  e.g. phase_10 follows phase_9 whatever order the file system lists them in.
+    """
+    files = [files for files in os.listdir(dirname) if files.endswith(ext)]
+    indices = [phase_index(files) for files in files]
+    if len(set(indices)) != len(indices):
+        raise ValueError('Several files share a phase index in {}'.format(dirname))
+    return [os.path.join(dirname, files) for _, files in sorted(zip(indices, files))]
+
+
+def _read_npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _read_npy_into(path, out):
+    # Read the raw data straight into the preallocated slot, the file read releases the GIL
+    with open(path, 'rb') as f:
+        shape, fortran_order, dtype = _read_npy_header(f)
+        if fortran_order or dtype != out.dtype or not out.flags.c_contiguous:
+            out[...] = np.load(path)
+        elif f.readinto(memoryview(out).cast('B')) != out.nbytes:
+            raise ValueError('{} is truncated'.format(path))
+
+
+def read_phase_headers(directories, ext='.npy'):
+    """
+    Reads the .npy header of every phase of every structure without reading the arrays, 
+    and checks that the phases of a structure share one dtype and that every structure 
+    has the same (Z, Y, X) shape.
+    Parameters
+    ----------
+    directories : Dictionary of structure name to the directory of its phase arrays
+    ext : File extension of the arrays
+    Returns
+    -------
+    headers : Dictionary of structure name to (phase_paths, shape, dtype), with the phase 
+              paths in phase index order.
+    """
+    headers = {}
+    volume_shape = None
+    for name, dirname in directories.items():
+        phase_paths = phase_files(dirname, ext)
+        if not phase_paths:
+            raise ValueError('No {} files in {}'.format(ext, dirname))
+        phase_headers = []
+        for path in phase_paths:
+            with open(path, 'rb') as f:
+                phase_headers.append(_read_npy_header(f))
+        shape, _, dtype = phase_headers[0]
+        for path, (phase_shape, _, phase_dtype) in zip(phase_paths, phase_headers):
+            if phase_shape != shape or phase_dtype != dtype:
+                raise ValueError('{} is {} {}, expected {} {} like the other {} phases'.format(
+                    path, phase_dtype, phase_shape, dtype, shape, name))
+        if volume_shape is not None and shape != volume_shape:
+            raise ValueError('{} phases are {}, expected {}'.format(name, shape, volume_shape))
+        volume_shape = shape
+        headers[name] = (phase_paths, shape, dtype)
+    return headers
+
+
+def load_phase_stacks(directories, ext='.npy', workers=8, headers=None):
+    """
+    Loads every phase of every structure concurrently with a thread pool into one 
+    preallocated (phases, Z, Y, X) array per structure, in phase index order.
+    Parameters
+    ----------
+    directories : Dictionary of structure name to the directory of its phase arrays
+    ext : File extension of the arrays
+    workers : Number of threads reading files
+    headers : Headers of the structures from read_phase_headers, if already read. 
+              By default they are read and validated before anything is loaded.
+    Returns
+    -------
+    stacks : Dictionary of structure name to its (phases, Z, Y, X) array.
+    """
+    if headers is None:
+        headers = read_phase_headers(directories, ext)
+    stacks = {name: np.empty((len(headers[name][0]),) + headers[name][1], dtype=headers[name][2]) 
+              for name in directories}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reads = [executor.submit(_read_npy_into, path, stacks[name][phase])
+                 for name in directories for phase, path in enumerate(headers[name][0])]
+        for read in reads:
+            read.result()
+    return stacks
+
+
+def run_pre_processing(patient, data_dir='.', output_dir='.', calibration='default', voxel_size=(3.0,1.0527,1.0527),
+                       expansion_magnitude=5, body_margin=10, workers=None):
+    """
+    Pre-processing pipeline of one patient: AIP, MIP and MinIP CTs, RSP conversion, body 
+    cropping, ITV/CTV/iCTV and OAR maps, all saved in the volume container 
+    <output_dir>/<patient>_volumes. Nothing is plotted.
+    Parameters
+    ----------
+    patient : Patient identifier, e.g. 'p104'
+    data_dir : Directory holding the patient's structure directories, see patient_directories
+    output_dir : Directory the volume container is written to
+    calibration : HUToRSPCalibration, or name/path of the calibration curve of the scanner
+    voxel_size : Voxel dimensions of the CT scan
+    expansion_magnitude : GTV to CTV margin in mm
+    body_margin : Margin around the body outline kept when cropping, in mm
+    workers : Number of processes expanding the CTV phases, see generate_itv_ctv_ictv_edt
+    Returns
+    -------
+    results : Dictionary of name to every generated (cropped) array, including 'ct_eval_rsp' 
+              as the memory-mapped array of the container.
+    """
+    if not isinstance(calibration, HUToRSPCalibration):
+        calibration = load_calibration(calibration)
+    directories = patient_directories(patient, data_dir)
+    #Check the phase files of the CT and every structure before reading any of them
+    headers = read_phase_headers(directories)
+    ct_files, ct_shape, _ = headers['ct']
+    for name, (phase_paths, _, _) in headers.items():
+        if len(phase_paths) != len(ct_files):
+            raise ValueError('{} has {} phases, the CT has {}'.format(name, len(phase_paths), len(ct_files)))
+    #The CT phases are streamed below, the structures are loaded concurrently into (phases, Z, Y, X) stacks
+    structure_stacks = load_phase_stacks({name: dirname for name, dirname in directories.items() if name != 'ct'}, 
+                                         headers=headers)
+    os.makedirs(output_dir, exist_ok=True)
+    #Open the patient's volume container, the RSP 4D CT is written straight into it
+    container = VolumeContainerWriter(os.path.join(output_dir, patient + '_volumes'), voxel_size)
+    #Generate AIP,MIP and MinIP CT scans and transfrom 4D CT scans from HU to RSP in a single streaming pass.
+    #Only the container holds the full size RSP map, so it is released when the container crops it.
+    AIP_ct, MIP_ct ,MinIP_ct = stream_ct_maps(ct_files, container.allocate('ct_eval_rsp', (len(ct_files),) + ct_shape), 
+                                              calibration)
+    #Segment the body outline on the AIP and crop every volume to its bounding box,
+    #removing the air and couch around the patient. The offset is kept in the container metadata.
+    body = segment_body(AIP_ct)
+    body_box = margin_bounding_box(body, voxel_size, body_margin)
+    ct_eval_rsp = container.crop(body_box, body.shape)['ct_eval_rsp']
+    body, AIP_ct, MIP_ct, MinIP_ct = crop_to_box([body, AIP_ct, MIP_ct, MinIP_ct], body_box)
+    structure_stacks = {name: crop_to_box(stack, body_box) for name, stack in structure_stacks.items()}
+    #Transfrom AIP and MIP CT scans from HU to RSP.
+    ct_ave_rsp = transform_Single_CT_HU_to_RSP(AIP_ct, calibration)
+    ct_mip_rsp = transform_Single_CT_HU_to_RSP(MIP_ct, calibration)
+    #Generate ITV,CTV and iCTV with an exact margin (distance transform, phases expanded in parallel)
+    itv, ctv_list , ictv = generate_itv_ctv_ictv_edt(structure_stacks['tumor'], voxel_size, expansion_magnitude, workers)
+    #Generate OAR Maps
+    heart = generate_oar_maps(structure_stacks['heart'])
+    cord = generate_oar_maps(structure_stacks['cord'])
+    rlung = generate_oar_maps(structure_stacks['rlung'])
+    llung = generate_oar_maps(structure_stacks['llung'])
+    #Generate combined lung contour
+    lungs = np.logical_or(rlung, llung)
+    ##Crop the lung at the iCTV boundary
+    lungs = crop_oar(lungs,ictv)
+    results = {'ct_eval_rsp': ct_eval_rsp, 'ct_ave': AIP_ct, 'ct_mip': MIP_ct, 'ct_min_ip': MinIP_ct,
+               'ct_ave_rsp': ct_ave_rsp, 'ct_mip_rsp': ct_mip_rsp, 'body': body, 'itv': itv, 
+               'ctv_list': ctv_list, 'ictv': ictv, 'heart': heart, 'cord': cord, 'rlung': rlung, 
+               'llung': llung, 'lungs': lungs}
+    ### Save all volumes of the patient in the memory-mappable container
+    for name in ('ct_ave', 'ct_mip', 'ct_min_ip'):
+        container.add(name, results[name], 'hu')
+    for name in ('ct_ave_rsp', 'ct_mip_rsp'):
+        container.add(name, results[name], 'volume')
+    for name in ('body', 'itv', 'ictv', 'heart', 'cord', 'rlung', 'llung', 'lungs'):
+        container.add(name, results[name], 'mask')
+    #metadata.json is written last, so it also marks the container as complete
+    container.close()
+    return results
+
+
+def memory_report(arrays):
+    """
+    Parameters
+    ----------
+    arrays : Dictionary of name to array or list of arrays, e.g. the results of run_pre_processing
+    Returns
+    -------
+    report : Dictionary of name to (dtype, MB) of every array, and 'total' to the total MB. 
+             Memory-mapped arrays are left out, they are not held in memory.
+    """
+    report = {}
+    for name, array in arrays.items():
+        array_list = array if isinstance(array, (list, tuple)) else [array]
+        if not array_list or isinstance(array_list[0], np.memmap):
+            continue
+        report[name] = (str(np.asarray(array_list[0]).dtype), sum(np.asarray(a).nbytes for a in array_list) / 1e6)
+    report['total'] = sum(megabytes for _, megabytes in report.values())
+    return report
+
 
+def pre_processing_up_to_date(patient, data_dir='.', output_dir='.', calibration='default'):
+    """
+    Parameters
+    ----------
+    patient : Patient identifier, e.g. 'p104'
+    data_dir : Directory holding the patient's structure directories
+    output_dir : Directory of the patient's volume container
+    calibration : Name or path of the calibration curve of the scanner
+    Returns
+    -------
+    up_to_date : True if the container is complete and newer than every input array and 
+                 the calibration curve.
+    """
+    metadata_path = os.path.join(output_dir, patient + '_volumes', 'metadata.json')
+    if not os.path.isfile(metadata_path):
+        return False
+    input_paths = [calibration_path(calibration)]
+    for dirname in patient_directories(patient, data_dir).values():
+        input_paths.append(dirname)
+        input_paths += [os.path.join(dirname, files) for files in os.listdir(dirname)]
+    return os.path.getmtime(metadata_path) >= max(os.path.getmtime(path) for path in input_paths)
+
+
+def estimate_pre_processing_memory(patient, data_dir='.'):
+    """
+    Rough peak memory of run_pre_processing for one patient: every structure phase held in 
+    memory plus the phases, accumulators and float32 RSP maps of the streaming pass.
+    Parameters
+    ----------
+    patient : Patient identifier, e.g. 'p104'
+    data_dir : Directory holding the patient's structure directories
+    Returns
+    -------
+    peak_bytes : Estimated peak memory in bytes.
+    """
+    directories = patient_directories(patient, data_dir)
+    structure_bytes = 0
+    for name, dirname in directories.items():
+        if name != 'ct':
+            structure_bytes += sum(os.path.getsize(os.path.join(dirname, files)) for files in os.listdir(dirname))
+    ct = np.load(phase_files(directories['ct'])[0], mmap_mode='r')
+    # Phase being processed and phase read ahead, MIP, MinIP, float32 sum (divided in place 
+    # into the AIP), float32 AIP and MIP RSP
+    ct_bytes = ct.size * (4 * ct.itemsize + 4 + 2 * 4)
+    return structure_bytes + ct_bytes
+
+
+def available_memory():
+    """
+    Returns
+    -------
+    available : Available physical memory in bytes, or None if it can not be determined.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def read_manifest(path):
+    """
+    Parameters
+    ----------
+    path : CSV file with a header and one row per patient, with the columns 'patient', 
+           'data_dir' and optionally 'calibration' (name or path of the scanner curve)
+    Returns
+    -------
+    patients : A list of dictionaries with the patient, data_dir and calibration of every row.
+    """
+    with open(path, newline='') as f:
+        patients = [{'patient': row['patient'].strip(), 'data_dir': row['data_dir'].strip(),
+                     'calibration': (row.get('calibration') or 'default').strip()} for row in csv.DictReader(f)]
+    return patients
+
+
+def _run_batch_patient(patient, data_dir, output_dir, calibration, force):
+    start = time.time()
+    if not force and pre_processing_up_to_date(patient, data_dir, output_dir, calibration):
+        return patient, 'up to date', 0.0
+    try:
+        run_pre_processing(patient, data_dir, output_dir, calibration, workers=1)
+    except Exception as error:
+        return patient, 'failed: {}'.format(error), time.time() - start
+    return patient, 'processed', time.time() - start
+
+
+def run_batch_pre_processing(manifest, output_root, workers=None, memory_limit=None, force=False):
+    """
+    Runs run_pre_processing for every patient of a manifest in a process pool, writing the 
+    container of each patient into its own folder <output_root>/<patient>. Patients whose 
+    container is newer than all their inputs are skipped. The number of concurrent 
+    patients is limited by the CPUs and by the memory estimate of the largest patient.
+    Parameters
+    ----------
+    manifest : Manifest CSV file, see read_manifest, or the list it returns
+    output_root : Directory of the per-patient output folders
+    workers : Maximum number of patients processed concurrently. None uses all CPUs.
+    memory_limit : Memory in bytes the batch may use. None uses 80% of the available memory.
+    force : True to re-process patients that are up to date
+    Returns
+    -------
+    status : A list of (patient, status, seconds) tuples in manifest order, where status is 
+             'processed', 'up to date' or 'failed: <error>'.
+    """
+    patients = read_manifest(manifest) if isinstance(manifest, str) else list(manifest)
+    if not patients:
+        return []
+    if workers is None:
+        workers = os.cpu_count()
+    if memory_limit is None and available_memory() is not None:
+        memory_limit = 0.8 * available_memory()
+    if memory_limit is not None:
+        peak_bytes = max(estimate_pre_processing_memory(row['patient'], row['data_dir']) for row in patients)
+        workers = min(workers, int(memory_limit // peak_bytes))
+    workers = max(1, min(workers, len(patients)))
+    print('pre-processing {} patients with {} workers'.format(len(patients), workers))
+    arguments = [(row['patient'], row['data_dir'], os.path.join(output_root, row['patient']), row['calibration'], force)
+                 for row in patients]
+    status = {}
+    if workers == 1:
+        for argument in arguments:
+            patient, result, seconds = _run_batch_patient(*argument)
+            status[patient] = (patient, result, seconds)
+            print('{}: {} ({:.1f} s)'.format(patient, result, seconds))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_batch_patient, *argument) for argument in arguments]
+            for future in as_completed(futures):
+                patient, result, seconds = future.result()
+                status[patient] = (patient, result, seconds)
+                print('{}: {} ({:.1f} s)'.format(patient, result, seconds))
+    return [status[row['patient']] for row in patients]
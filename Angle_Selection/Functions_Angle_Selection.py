@@ -7,26 +7,45 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.spatial.distance import euclidean
+import contextlib
+import hashlib
+import heapq
+import json
+import mmap
+import os
 import pickle 
+import sys
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from scipy import stats
 import seaborn as sns
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not recorded
+    resource = None
 
 """
 Functions utilised for the Angle-Selection Algorithm
 """
 
-def calculate_distances(lines_coords ):
+def calculate_distances(lines_coords, voxel_size=(3.0,1.0527,1.0527)):
     """
     Parameters
     ----------
-    lines_coords : Array represending the coordinates that the beam passes through
+    lines_coords : Array represending the coordinates that the beam passes through, 
+                   or a BeamPath
+    voxel_size : Voxel dimensions of the CT scan
     Returns
     -------
     distances : Euclidean Chord Distance taking into consideration voxel dimensions. 
 
     """
+    if isinstance(lines_coords, BeamPath):
+        return lines_coords.chord
     distances = []
-    voxel_size= [3.0,1.0527,1.0527]
     for line_coords in lines_coords:
         first_point = np.array(line_coords[0]) * voxel_size
         last_point = np.array(line_coords[-1]) * voxel_size
@@ -66,7 +85,6 @@ def generate_steps(theta,phi,direction_vector):
                             [sin_c, 0, cos_c]])
     trans_matrix = np.matmul(trans_matrix_c, trans_matrix_g)
     z_step, y_step, x_step = np.matmul(trans_matrix, [0,-1,0])
-    print('step size is' ,z_step, y_step, x_step )
     return (z_step, y_step, x_step)
 
 
@@ -84,33 +102,367 @@ def get_distal_edge_point(tumor, steps, threshold=40):
     distal_points : A list of all the distal edge points coordinates
     distal_array : A 3D array representing the distal edge.
     """
-    print('Calculating distal points')
-    distal_points = []
     distal_array = np.zeros_like(tumor)
     z_step, y_step, x_step = steps
-    for i in range(tumor.shape[0]):
-        for j in range(tumor.shape[1]):
-            for k in range(tumor.shape[2]):
-                if tumor[i, j, k] == 1:
-                    z, y, x = i - z_step, j - y_step, k - x_step
-                    count = 0
-                    is_distal_edge = False
-                    while z >= 0 and int(np.round(z)) < tumor.shape[0] and y >= 0 and int(np.round(y)) < tumor.shape[1] and x >= 0 and int(np.round(x)) < tumor.shape[2] and count < threshold:
-                        z_round, y_round, x_round = int(np.round(z)),int(np.round(y)),int(np.round(x))
-                        if tumor[z_round, y_round, x_round] == 0:
-                            break
-                        if tumor[z_round, y_round, x_round] == 1:
-                            is_distal_edge = True
-                        count += 1
-                        z, y, x = z - z_step, y - y_step, x - x_step
-                    if is_distal_edge and count < threshold:
-                        z, y, x = int(z), int(y), int(x)
-                        distal_points.append((z, y, x))
-                        distal_array[z,y,x] = 1
-            distal_points =[*set(distal_points)]
+    # Walk all tumour voxels against the beam direction at once. Only the walks that
+    # are still inside the tumour are gathered at each step.
+    start = np.argwhere(tumor == 1)
+    z, y, x = start[:, 0] - z_step, start[:, 1] - y_step, start[:, 2] - x_step
+    count = np.zeros(len(start), dtype=int)
+    is_distal_edge = np.zeros(len(start), dtype=bool)
+    active = np.arange(len(start))
+    for _ in range(threshold):
+        if active.size == 0:
+            break
+        z_active, y_active, x_active = z[active], y[active], x[active]
+        z_round = np.round(z_active).astype(int)
+        y_round = np.round(y_active).astype(int)
+        x_round = np.round(x_active).astype(int)
+        inside = ((z_active >= 0) & (z_round < tumor.shape[0]) &
+                  (y_active >= 0) & (y_round < tumor.shape[1]) &
+                  (x_active >= 0) & (x_round < tumor.shape[2]))
+        active = active[inside]
+        voxel = tumor[z_round[inside], y_round[inside], x_round[inside]]
+        active, voxel = active[voxel != 0], voxel[voxel != 0]
+        is_distal_edge[active] |= voxel == 1
+        count[active] += 1
+        z[active] -= z_step
+        y[active] -= y_step
+        x[active] -= x_step
+    edge = is_distal_edge & (count < threshold)
+    distal = np.stack((z[edge], y[edge], x[edge]), axis=1).astype(int)
+    distal = np.unique(distal.reshape(-1, 3), axis=0)
+    distal_array[distal[:, 0], distal[:, 1], distal[:, 2]] = 1
+    distal_points = [tuple(point) for point in distal.tolist()]
     return distal_points , distal_array
 
 
+def march_rays(shape, distal_points, steps):
+    """
+    Parameters
+    ----------
+    shape : Shape of the 3D volume the rays are traced through
+    distal_points : Array representing the distal edge points for the specific angle combinations 
+    steps : Steps that will define the direction of the beam based on the angle combinations
+    Returns
+    -------
+    ray_voxels : An (N, 3) array of the unique voxels visited by all rays, grouped by ray and 
+                 ordered from the distal edge point outwards
+    ray_offsets : An array of length (number of rays + 1); the voxels of ray r are 
+                  ray_voxels[ray_offsets[r]:ray_offsets[r+1]]
+    """
+    points = np.asarray(distal_points, dtype=int).reshape(-1, 3)
+    position = points.astype(float)
+    last_voxel = np.full(points.shape, -1)
+    active = np.arange(len(points))
+    visited_rays = []
+    visited_voxels = []
+    # Advance every ray of the beam together and drop rays once they leave the volume.
+    while active.size:
+        voxel = position[active].astype(int)
+        inside = np.all((voxel >= 0) & (voxel < shape), axis=1)
+        active, voxel = active[inside], voxel[inside]
+        # Rays move monotonically along each axis, so a repeated voxel is always the previous one
+        new = np.any(voxel != last_voxel[active], axis=1)
+        visited_rays.append(active[new])
+        visited_voxels.append(voxel[new])
+        last_voxel[active] = voxel
+        position[active] += steps
+    if not visited_rays:
+        return np.empty((0, 3), dtype=int), np.zeros(1, dtype=int)
+    visited_rays = np.concatenate(visited_rays)
+    order = np.argsort(visited_rays, kind='stable')
+    ray_voxels = np.concatenate(visited_voxels)[order]
+    ray_offsets = np.zeros(len(points) + 1, dtype=int)
+    ray_offsets[1:] = np.cumsum(np.bincount(visited_rays, minlength=len(points)))
+    return ray_voxels, ray_offsets
+
+
+class BeamMask:
+    """
+    Compact beam mask stored as the sorted unique linear indices of the voxels the beam 
+    passes through, instead of a dense array the size of the CT. A dense array is only 
+    built on demand with to_dense, e.g. for plotting.
+    Parameters
+    ----------
+    shape : Shape of the 3D volume the beam was traced through
+    indices : Linear indices of the voxels in the beam
+    assume_unique : True if indices are already sorted and unique
+    """
+
+    def __init__(self, shape, indices, assume_unique=False):
+        index_dtype = np.int32 if np.prod(shape) < np.iinfo(np.int32).max else np.int64
+        self.shape = tuple(shape)
+        self.indices = np.asarray(indices, dtype=index_dtype)
+        if not assume_unique:
+            self.indices = np.unique(self.indices)
+
+    @classmethod
+    def from_dense(cls, lines):
+        """
+        Parameters
+        ----------
+        lines : Dense 3D array, non-zero where the beam passes through
+        Returns
+        -------
+        beam_mask : BeamMask of the non-zero voxels.
+        """
+        return cls(lines.shape, np.flatnonzero(lines), assume_unique=True)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes
+
+    def count(self):
+        """Number of voxels in the beam."""
+        return len(self.indices)
+
+    def union(self, other):
+        """Voxels in this beam or in another BeamMask."""
+        return BeamMask(self.shape, np.union1d(self.indices, other.indices), assume_unique=True)
+
+    def intersection(self, other):
+        """
+        Parameters
+        ----------
+        other : BeamMask, or organ mask array of the same shape as the beam volume
+        Returns
+        -------
+        beam_mask : BeamMask of the voxels in both.
+        """
+        if isinstance(other, BeamMask):
+            indices = np.intersect1d(self.indices, other.indices, assume_unique=True)
+        else:
+            indices = self.indices[np.take(other, self.indices) >= 1]
+        return BeamMask(self.shape, indices, assume_unique=True)
+
+    def intersection_count(self, other):
+        """Number of voxels in both this beam and another BeamMask or organ mask array."""
+        if isinstance(other, BeamMask):
+            return len(np.intersect1d(self.indices, other.indices, assume_unique=True))
+        return int(np.count_nonzero(np.take(other, self.indices) >= 1))
+
+    def gather(self, volume):
+        """Values of a volume at the voxels of the beam."""
+        return np.take(volume, self.indices)
+
+    def to_dense(self, dtype=bool):
+        """Dense 3D array that is True (1) where the beam passes through."""
+        lines = np.zeros(self.shape, dtype=dtype)
+        lines.flat[self.indices] = 1
+        return lines
+
+
+class BeamPath:
+    """
+    Compact ragged representation of all the rays of a single beam. The voxels of every 
+    ray are stored as flat (linear) voxel indices, concatenated ray after ray, and 
+    offsets[r]:offsets[r+1] selects the voxels of ray r.
+    Parameters
+    ----------
+    shape : Shape of the 3D volume the rays were traced through
+    indices : Linear voxel indices of all rays, ordered from the distal edge point outwards
+    offsets : Ray offsets into indices, of length (number of rays + 1)
+    chord : Euclidean chord distance per voxel of every ray
+    lengths : Optional intersection length (mm) of every voxel in indices. Set by the 
+              Siddon tracer; when present WEPL uses the true lengths instead of the chord.
+    """
+
+    def __init__(self, shape, indices, offsets, chord, lengths=None):
+        index_dtype = np.int32 if np.prod(shape) < np.iinfo(np.int32).max else np.int64
+        self.shape = tuple(shape)
+        self.indices = np.asarray(indices, dtype=index_dtype)
+        self.offsets = np.asarray(offsets, dtype=index_dtype)
+        self.chord = np.asarray(chord, dtype=float)
+        self.lengths = None if lengths is None else np.asarray(lengths, dtype=float)
+        self._mask = None
+
+    @classmethod
+    def from_ray_voxels(cls, shape, ray_voxels, ray_offsets, voxel_size=(3.0,1.0527,1.0527)):
+        """
+        Parameters
+        ----------
+        shape : Shape of the 3D volume the rays were traced through
+        ray_voxels : An (N, 3) array of voxel coordinates grouped by ray, as returned by march_rays
+        ray_offsets : Ray offsets into ray_voxels, as returned by march_rays
+        voxel_size : Voxel dimensions of the CT scan
+        Returns
+        -------
+        beam_path : BeamPath of the rays.
+        """
+        ray_voxels = np.asarray(ray_voxels, dtype=int).reshape(-1, 3)
+        ray_offsets = np.asarray(ray_offsets, dtype=int)
+        indices = np.ravel_multi_index(tuple(ray_voxels.T), shape)
+        traced = np.diff(ray_offsets) > 0
+        chord = np.full(len(ray_offsets) - 1, np.nan)
+        first_point = ray_voxels[ray_offsets[:-1][traced]] * np.asarray(voxel_size)
+        last_point = ray_voxels[ray_offsets[1:][traced] - 1] * np.asarray(voxel_size)
+        num_vox = np.diff(ray_offsets)[traced] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chord[traced] = np.linalg.norm(last_point - first_point, axis=1) / num_vox
+        return cls(shape, indices, ray_offsets, chord)
+
+    @classmethod
+    def from_lines_coords(cls, shape, lines_coords, voxel_size=(3.0,1.0527,1.0527)):
+        """
+        Parameters
+        ----------
+        shape : Shape of the 3D volume the rays were traced through
+        lines_coords : List of lists of (z, y, x) coordinates the beam passes through
+        voxel_size : Voxel dimensions of the CT scan
+        Returns
+        -------
+        beam_path : BeamPath of the rays.
+        """
+        ray_offsets = np.zeros(len(lines_coords) + 1, dtype=int)
+        ray_offsets[1:] = np.cumsum([len(line_coords) for line_coords in lines_coords])
+        ray_voxels = [coord for line_coords in lines_coords for coord in line_coords]
+        return cls.from_ray_voxels(shape, ray_voxels, ray_offsets, voxel_size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        nbytes = self.indices.nbytes + self.offsets.nbytes + self.chord.nbytes
+        if self.lengths is not None:
+            nbytes += self.lengths.nbytes
+        return nbytes
+
+    def ray_counts(self):
+        """Number of voxels traversed by every ray."""
+        return np.diff(self.offsets)
+
+    def unique_indices(self):
+        """Sorted linear indices of all voxels the beam passes through."""
+        return self.mask().indices
+
+    def mask(self):
+        """BeamMask of all voxels the beam passes through."""
+        if self._mask is None:
+            self._mask = BeamMask(self.shape, self.indices)
+        return self._mask
+
+    def voxels(self):
+        """(N, 3) array of the voxel coordinates of all rays."""
+        return np.stack(np.unravel_index(self.indices, self.shape), axis=1)
+
+    def ray_sum(self, values):
+        """
+        Parameters
+        ----------
+        values : Per-voxel values aligned with indices. Leading axes (e.g. phases) are kept.
+        Returns
+        -------
+        ray_sums : Sum of values along every ray.
+        """
+        values = np.asarray(values)
+        counts = self.ray_counts()
+        ray_sums = np.zeros(values.shape[:-1] + (len(self),), dtype=np.result_type(values, float))
+        if values.shape[-1]:
+            ray_sums[..., counts > 0] = np.add.reduceat(values, self.offsets[:-1][counts > 0], 
+                                                        axis=-1, dtype=ray_sums.dtype)
+        return ray_sums
+
+    def lines_coords(self):
+        """List of lists of (z, y, x) tuples, one list per ray."""
+        voxels = [tuple(voxel) for voxel in self.voxels().tolist()]
+        return [voxels[self.offsets[r]:self.offsets[r + 1]] for r in range(len(self))]
+
+
+def trace_rays_siddon(shape, distal_points, steps, voxel_size=(3.0,1.0527,1.0527)):
+    """
+    Exact radiological path tracing (Siddon/Jacobs) of all rays of a beam. Rays start at 
+    the distal edge points and follow the step direction, as in march_rays, with voxel 
+    (i, j, k) covering [i, i+1) x [j, j+1) x [k, k+1) in index coordinates. Every voxel 
+    boundary crossing is computed exactly, so each voxel gets its true intersection length.
+    Parameters
+    ----------
+    shape : Shape of the 3D volume the rays are traced through
+    distal_points : Array representing the distal edge points for the specific angle combinations 
+    steps : Steps that will define the direction of the beam based on the angle combinations
+    voxel_size : Voxel dimensions of the CT scan
+    Returns
+    -------
+    ray_voxels : An (N, 3) array of the voxels intersected by all rays, grouped by ray and 
+                 ordered from the distal edge point outwards
+    ray_offsets : Ray offsets into ray_voxels, of length (number of rays + 1)
+    ray_lengths : Intersection length (mm) of the ray with every voxel in ray_voxels
+    """
+    start = np.asarray(distal_points, dtype=float).reshape(-1, 3)
+    steps = np.asarray(steps, dtype=float)
+    shape = np.asarray(shape)
+    num_rays = len(start)
+    moving = np.abs(steps) > 1e-12
+    # Parametric distance (in steps) at which every ray leaves the volume
+    with np.errstate(divide='ignore'):
+        exit_plane = np.where(steps > 0, shape, 0)
+        alpha_exit = np.where(moving, (exit_plane - start) / np.where(moving, steps, 1), np.inf)
+    alpha_max = np.clip(np.min(alpha_exit, axis=1), 0, None)
+    # Parametric distances of all voxel boundary crossings, per axis and per ray
+    ray_ids = [np.arange(num_rays), np.arange(num_rays)]
+    alphas = [np.zeros(num_rays), alpha_max]
+    for axis in np.flatnonzero(moving):
+        step = abs(steps[axis])
+        if steps[axis] > 0:
+            first = (np.floor(start[:, axis]) + 1 - start[:, axis]) / step
+        else:
+            first = (start[:, axis] - np.ceil(start[:, axis]) + 1) / step
+        crossings = np.where(alpha_max > first, np.ceil((alpha_max - first) * step - 1e-9), 0).astype(int)
+        ray = np.repeat(np.arange(num_rays), crossings)
+        plane = np.arange(crossings.sum()) - np.repeat(np.cumsum(crossings) - crossings, crossings)
+        ray_ids.append(ray)
+        alphas.append(first[ray] + plane / step)
+    ray_ids = np.concatenate(ray_ids)
+    alphas = np.concatenate(alphas)
+    order = np.lexsort((alphas, ray_ids))
+    ray_ids, alphas = ray_ids[order], alphas[order]
+    # Consecutive crossings of the same ray bound one voxel segment
+    segment = (ray_ids[1:] == ray_ids[:-1]) & (np.diff(alphas) > 1e-9)
+    segment_ray = ray_ids[:-1][segment]
+    alpha_start, alpha_end = alphas[:-1][segment], alphas[1:][segment]
+    midpoint = start[segment_ray] + ((alpha_start + alpha_end) / 2)[:, None] * steps
+    ray_voxels = np.clip(np.floor(midpoint).astype(int), 0, shape - 1)
+    ray_lengths = (alpha_end - alpha_start) * np.linalg.norm(steps * np.asarray(voxel_size))
+    ray_offsets = np.zeros(num_rays + 1, dtype=int)
+    ray_offsets[1:] = np.cumsum(np.bincount(segment_ray, minlength=num_rays))
+    return ray_voxels, ray_offsets, ray_lengths
+
+
+def generate_beam_path(tumor, distal_points, steps, voxel_size=(3.0,1.0527,1.0527), tracer='step'):
+    """
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    distal_points : Array representing the distal edge points for the specific angle combinations 
+    steps : Steps that will define the direction of the beam based on the angle combinations
+    voxel_size : Voxel dimensions of the CT scan
+    tracer : 'step' for unit-step ray marching, or 'siddon' for exact voxel intersection lengths
+    Returns
+    -------
+    lines : BeamMask of all the voxels that the beam will pass through
+    beam_path : BeamPath holding the voxels from every distal edge point 
+                to the last point of the beam before it goes out of bounds
+    """
+    if tracer == 'step':
+        ray_voxels, ray_offsets = march_rays(tumor.shape, distal_points, steps)
+        beam_path = BeamPath.from_ray_voxels(tumor.shape, ray_voxels, ray_offsets, voxel_size)
+    elif tracer == 'siddon':
+        ray_voxels, ray_offsets, ray_lengths = trace_rays_siddon(tumor.shape, distal_points, steps, voxel_size)
+        indices = np.ravel_multi_index(tuple(ray_voxels.T), tumor.shape)
+        beam_path = BeamPath(tumor.shape, indices, ray_offsets, np.nan, ray_lengths)
+        # Mean intersection length per voxel stands in for the chord distance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beam_path.chord = beam_path.ray_sum(ray_lengths) / beam_path.ray_counts()
+    else:
+        raise ValueError("tracer must be 'step' or 'siddon', not {!r}".format(tracer))
+    lines = beam_path.mask()
+    return lines, beam_path
+
+
 def generate_lines(tumor, distal_points, steps):
     """
     Parameters
@@ -126,37 +478,217 @@ def generate_lines(tumor, distal_points, steps):
         DESCRIPTION.
 
     """
-    print('Generating lines')
-    lines_coords = []
-    lines_coords_set = []
-    lines = np.zeros_like(tumor)
-    z_step, y_step, x_step = steps
-    for distal_point in distal_points:
-        i, j, k = distal_point[:3]
-        line_coords = []
-        line_coords_set = set()
-        z, y, x = i,j,k
-        while (0 <= int(z) < tumor.shape[0]) and (0 <= int(y) < tumor.shape[1]) and (0 <= int(x) < tumor.shape[2]):
-            current_point = (int(z), int(y), int(x))
-            if current_point not in line_coords_set:
-                line_coords_set.add(current_point)
-                line_coords.append(current_point)
-            lines[int(z), int(y), int(x)] = 1
-            z += z_step
-            y += y_step
-            x += x_step
-        lines_coords.append(line_coords)
-        lines_coords_set.append(list(line_coords_set))
-    return lines , lines_coords
-
-
-
-def main(tumor, phi, theta):
-    steps = generate_steps(theta,phi,[0,-1,0])
-    distal_points , distal_array= get_distal_edge_point(tumor,steps)
-    lines ,lines_coords= generate_lines(tumor, distal_points,steps)
-    distance = calculate_distances(lines_coords)
-    return lines_coords,distance, lines
+    lines, beam_path = generate_beam_path(tumor, distal_points, steps)
+    return lines.to_dense(tumor.dtype) , beam_path.lines_coords()
+
+
+class StageTimer:
+    """
+    Wall time and counters of the stages of one beam geometry, collected into a flat 
+    record for the StageLog of a sweep. Stages and counters recorded more than once are 
+    summed.
+    Parameters
+    ----------
+    fields : Fields the record starts with, e.g. the couch and gantry angle
+    """
+
+    def __init__(self, **fields):
+        self.record = dict(fields)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Adds the wall time of the with-block to the '<name>_seconds' field."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = name + '_seconds'
+            self.record[key] = self.record.get(key, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value):
+        self.record[name] = self.record.get(name, 0) + int(value)
+
+
+def peak_memory_mb():
+    """
+    Returns
+    -------
+    peak : Peak resident memory of this process so far in MB, or None where the 
+           resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+class StageLog:
+    """
+    Structured log of a sweep: one StageTimer record per evaluated beam geometry, in the 
+    order of the geometries, with the wall time of every stage, the number of distal edge 
+    points, rays and voxels traced and the peak memory of the process that evaluated it.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary : Dictionary of every '<stage>_seconds' field to its total over the sweep.
+        """
+        df = self.to_dataframe()
+        return {column: float(df[column].sum()) for column in df.columns if column.endswith('_seconds')}
+
+    def write(self, path):
+        """
+        Parameters
+        ----------
+        path : Output file; '.csv' files are written as CSV, anything else as JSON lines
+        Returns
+        -------
+        None.
+        """
+        if path.endswith('.csv'):
+            self.to_dataframe().to_csv(path, index=False)
+        else:
+            with open(path, 'w') as f:
+                for record in self.records:
+                    # NumPy scalars (e.g. angles from an array) are written as plain numbers
+                    f.write(json.dumps(record, default=float) + '\n')
+
+
+def main(tumor, phi, theta, tracer='step', cache=None, timer=None, voxel_size=(3.0,1.0527,1.0527), threshold=40):
+    """
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    phi : Couch Angle in degrees
+    theta : Gantry Angle in degrees
+    tracer : 'step' for unit-step ray marching, or 'siddon' for exact voxel intersection lengths
+    cache : Optional BeamGeometryCache; cached geometries are reused instead of traced
+    timer : Optional StageTimer recording the 'cache', 'distal_edge' and 'trace' stages 
+            and the number of 'distal_points', 'rays' and 'voxels' traced
+    voxel_size : Voxel dimensions of the CT scan
+    threshold : Threshold of the distal edge search, see get_distal_edge_point
+    Returns
+    -------
+    beam_path : BeamPath of the beam
+    distance : The Euclidean chord distance of every ray
+    lines : BeamMask of all the voxels that the beam will pass through
+    """
+    if timer is None:
+        timer = StageTimer()
+    beam_path = None
+    if cache is not None:
+        with timer.stage('cache'):
+            beam_path = cache.load(phi, theta, tracer, voxel_size, threshold)
+    if beam_path is None:
+        steps = generate_steps(theta,phi,[0,-1,0])
+        with timer.stage('distal_edge'):
+            distal_points , distal_array= get_distal_edge_point(tumor,steps, threshold)
+        with timer.stage('trace'):
+            lines ,beam_path= generate_beam_path(tumor, distal_points,steps, voxel_size, tracer=tracer)
+        timer.count('distal_points', len(distal_points))
+        if cache is not None:
+            with timer.stage('cache'):
+                cache.save(beam_path, phi, theta, tracer, voxel_size, threshold)
+    else:
+        lines = beam_path.mask()
+    timer.count('rays', len(beam_path))
+    timer.count('voxels', len(beam_path.indices))
+    distance = calculate_distances(beam_path)
+    return beam_path,distance, lines
+
+
+class BeamGeometryCache:
+    """
+    On-disk cache of traced beam paths. A beam path depends only on the tumour mask, the 
+    voxel grid, the distal edge threshold, the tracer and the couch/gantry angles, so it 
+    can be reused when the CT, RSP calibration or OAR contours change. Entries are keyed 
+    by a content hash of all of these, with the voxel grid and threshold taken from the 
+    trace they were saved for (see main); the least recently used entries are evicted 
+    once the cache grows beyond max_bytes.
+    Parameters
+    ----------
+    cache_dir : Directory the cached beam paths are written to
+    tumor : A 3D array describing tumor coordinates
+    max_bytes : Maximum total size of the cache in bytes
+    """
+
+    version = 2
+
+    def __init__(self, cache_dir, tumor, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        digest.update(np.packbits(np.asarray(tumor) == 1).tobytes())
+        digest.update(repr((self.version, tumor.shape)).encode())
+        self.tumor_digest = digest.hexdigest()
+
+    def path(self, phi, theta, tracer='step', voxel_size=(3.0,1.0527,1.0527), threshold=40):
+        key = repr((self.tumor_digest, float(phi), float(theta), tracer, tuple(map(float, voxel_size)), int(threshold)))
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.npz')
+
+    def load(self, phi, theta, tracer='step', voxel_size=(3.0,1.0527,1.0527), threshold=40):
+        """
+        Returns
+        -------
+        beam_path : The cached BeamPath for the couch/gantry angles and trace parameters, 
+                    or None if not cached.
+        """
+        path = self.path(phi, theta, tracer, voxel_size, threshold)
+        try:
+            with np.load(path) as data:
+                lengths = data['lengths'] if 'lengths' in data.files else None
+                beam_path = BeamPath(tuple(data['shape']), data['indices'], data['offsets'], 
+                                     data['chord'], lengths)
+            # Mark the entry as recently used for eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            return None
+        return beam_path
+
+    def save(self, beam_path, phi, theta, tracer='step', voxel_size=(3.0,1.0527,1.0527), threshold=40):
+        path = self.path(phi, theta, tracer, voxel_size, threshold)
+        data = {'shape': np.asarray(beam_path.shape), 'indices': beam_path.indices, 
+                'offsets': beam_path.offsets, 'chord': beam_path.chord}
+        if beam_path.lengths is not None:
+            data['lengths'] = beam_path.lengths
+        # Write to a temporary file first so parallel workers never read a partial entry
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
 
 
 def calculate_beam_wepl(ct, lines_coords, distance):
@@ -164,38 +696,166 @@ def calculate_beam_wepl(ct, lines_coords, distance):
     Parameters
     ----------
     ct : 3D array of the CT scan to be investigated
-    lines_coords : List of arrays that indicate the coordinates the beam passes through.
-    distance : The Euclidean chord distance.
+    lines_coords : BeamPath, or list of arrays that indicate the coordinates the beam passes through.
+    distance : The Euclidean chord distance. Not used for Siddon-traced beam paths, 
+               which carry the true per-voxel intersection lengths.
 
     Returns
     -------
-    beam_wepl : A list of the WEPL values of the projected beams
+    beam_wepl : An array of the WEPL values of the projected beams
         [BEV, each voxel is represented by the sum of all voxels behind it along the beam direction]. 
 
     """
-    beam_wepl = []
-    for line_cord in lines_coords:
-        line_sum = 0
-        for coord in line_cord:
-            line_sum += ct[coord[0], coord[1], coord[2]]
-        beam_wepl.append(line_sum * np.mean(distance))
+    beam_path = lines_coords
+    if not isinstance(beam_path, BeamPath):
+        beam_path = BeamPath.from_lines_coords(ct.shape, lines_coords)
+    if beam_path.lengths is not None:
+        beam_wepl = beam_path.ray_sum(np.take(ct, beam_path.indices) * beam_path.lengths)
+    else:
+        beam_wepl = beam_path.ray_sum(np.take(ct, beam_path.indices)) * np.mean(distance)
     return beam_wepl
 
+
+def open_volume_container(path, mmap_mode='r'):
+    """
+    Parameters
+    ----------
+    path : Directory of a volume container written by save_volume_container in pre-processing
+    mmap_mode : Memory-map mode of the arrays; None reads them fully into memory
+    Returns
+    -------
+    volumes : Dictionary of name to array. Arrays are memory-mapped, so only the pages 
+              touched (e.g. by the rays of a beam) are read from disk. Bit-packed contours 
+              are unpacked into boolean arrays in memory.
+    metadata : Dictionary with the voxel_size, origin and the dtype and shape of every array.
+    """
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    volumes = {}
+    for name, info in metadata['arrays'].items():
+        volumes[name] = np.load(os.path.join(path, info['file']), mmap_mode=mmap_mode)
+        if info.get('packed'):
+            volumes[name] = np.unpackbits(volumes[name], count=int(np.prod(info['shape']))).view(bool).reshape(info['shape'])
+        if volumes[name].dtype != np.dtype(info['dtype']) or list(volumes[name].shape) != info['shape']:
+            raise ValueError('Array "{}" in {} does not match its metadata'.format(name, path))
+    return volumes, metadata
+
+
+def uncrop_volume(array, metadata, fill_value=0):
+    """
+    Parameters
+    ----------
+    array : Array on the cropped grid of a volume container (e.g. a beam mask from to_dense), 
+            with the (Z, Y, X) axes last
+    metadata : Container metadata from open_volume_container
+    fill_value : Value of the voxels outside the cropped region
+    Returns
+    -------
+    restored : The array placed back on the original CT grid. Arrays of containers that were 
+               not cropped are returned unchanged.
+    """
+    if 'crop' not in metadata:
+        return array
+    offset = metadata['crop']['offset']
+    box = tuple(slice(start, start + size) for start, size in zip(offset, np.shape(array)[-3:]))
+    restored = np.full(np.shape(array)[:-3] + tuple(metadata['crop']['original_shape']), fill_value, 
+                       dtype=np.asarray(array).dtype)
+    restored[(Ellipsis,) + box] = array
+    return restored
+
+
+def stack_phases(ct_list, dtype=np.float32):
+    """
+    Parameters
+    ----------
+    ct_list : A list of 3D arrays, one per 4DCT phase
+    dtype : Data type of the stacked array
+    Returns
+    -------
+    ct_stack : A contiguous (phases, Z, Y, X) array of the 4DCT.
+    """
+    ct_stack = np.empty((len(ct_list),) + np.shape(ct_list[0]), dtype=dtype)
+    for phase, ct in enumerate(ct_list):
+        ct_stack[phase] = ct
+    return ct_stack
+
+
+def calculate_phase_wepl(ct_stack, ref_ct, beam_path, distance=None):
+    """
+    WEPL of every ray on the reference CT and on all 4DCT phases, from one gather and one 
+    segmented sum of the beam path per volume (see calculate_beam_wepl). On the 
+    phase-major stack a single gather of all phases is not faster, as every phase is 
+    still read at scattered voxels.
+    Parameters
+    ----------
+    ct_stack : A (phases, Z, Y, X) array of the RSP 4DCT, see stack_phases
+    ref_ct : 3D array of the reference RSP CT scan
+    beam_path : BeamPath of the beam investigated
+    distance : The Euclidean chord distance. Defaults to the chord stored in beam_path.
+    Returns
+    -------
+    ref_wepl : WEPL of every ray on the reference CT.
+    eval_wepl : A (phases, rays) array of the WEPL of every ray on every phase.
+    dif_wepl : A (phases, rays) array of the reference minus evaluated WEPL.
+    """
+    if distance is None:
+        distance = beam_path.chord
+    ref_wepl = calculate_beam_wepl(ref_ct, beam_path, distance)
+    eval_wepl = np.empty((len(ct_stack), len(beam_path)))
+    for phase, ct in enumerate(ct_stack):
+        eval_wepl[phase] = calculate_beam_wepl(ct, beam_path, distance)
+    dif_wepl = ref_wepl - eval_wepl
+    return ref_wepl, eval_wepl, dif_wepl
+
+
+def compare_tracers(tumor, ct, phi, theta):
+    """
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    ct : 3D array of the RSP CT scan used for the WEPL comparison
+    phi : Couch Angle in degrees
+    theta : Gantry Angle in degrees
+    Returns
+    -------
+    report : Dictionary with the tracing time, number of voxels and mean WEPL of the 'step' and 
+             'siddon' tracers, and the mean and maximum absolute WEPL difference per ray.
+    """
+    report = {}
+    wepls = {}
+    for tracer in ('step', 'siddon'):
+        start = time.perf_counter()
+        beam_path, distance, lines = main(tumor, phi, theta, tracer=tracer)
+        report[tracer + '_time'] = time.perf_counter() - start
+        wepls[tracer] = calculate_beam_wepl(ct, beam_path, distance)
+        report[tracer + '_voxels'] = len(beam_path.indices)
+        report[tracer + '_mean_wepl'] = np.mean(wepls[tracer])
+    dif_wepl = np.abs(wepls['siddon'] - wepls['step'])
+    report['mean_abs_dif_wepl'] = np.mean(dif_wepl)
+    report['max_abs_dif_wepl'] = np.max(dif_wepl)
+    return report
+
 def oar_irradiated_vol(oar,lines,oar_name):
     """
     Parameters
     ----------
     oar : Array of OAR investigated
-    lines : Array showing the beam path for specific angles 
+    lines : Array showing the beam path for specific angles, or a BeamMask or BeamPath
+    oar_name : Name of the OAR investigated
     Returns
     -------
     perc_oar_vol : Percentage volume overlap of the irradiated OAR.
 
     """
-    print('Calculate percentage irradiated volume of "{}"'.format(oar_name))
     oar_total_vol = np.sum(oar)
-    lines_oar = np.where(lines>=1, oar,0)
-    if np.max(lines_oar)>=1:
+    if isinstance(lines, BeamPath):
+        lines = lines.mask()
+    if isinstance(lines, BeamMask):
+        lines_oar = lines.gather(oar)
+    else:
+        # Only the OAR values inside the beam, instead of a CT-sized copy of the OAR
+        lines_oar = np.asarray(oar)[np.asarray(lines) >= 1]
+    if lines_oar.size and np.max(lines_oar)>=1:
         oar_beam_volume = np.sum(lines_oar)
         perc_oar_vol = (oar_beam_volume/oar_total_vol)*100
     else:
@@ -203,6 +863,416 @@ def oar_irradiated_vol(oar,lines,oar_name):
     return perc_oar_vol
 
 
+class OrganPIV:
+    """
+    Percentage irradiated volume of any number of organs from a single pass over the 
+    beam's voxels. Organ membership is precomputed once per patient as a labelled volume 
+    in which bit n of a voxel is set when the voxel belongs to organ n, so overlapping 
+    organs (e.g. lungs and rlung/llung) are counted correctly. The organ voxel counts are 
+    precomputed as well.
+    Parameters
+    ----------
+    oars : Dictionary of OAR name to OAR array (at most 63 organs)
+    """
+
+    def __init__(self, oars):
+        names = list(oars)
+        if len(names) > 63:
+            raise ValueError('OrganPIV supports at most 63 organs, got {}'.format(len(names)))
+        shape = np.shape(oars[names[0]]) if names else ()
+        labels = np.zeros(shape, dtype=np.min_scalar_type((1 << len(names)) - 1))
+        organ_volumes = np.zeros(len(names))
+        for bit, name in enumerate(names):
+            labels[np.asarray(oars[name]) >= 1] |= labels.dtype.type(1 << bit)
+            organ_volumes[bit] = np.sum(oars[name])
+        self.names = names
+        self.labels = labels
+        self.organ_volumes = organ_volumes
+
+    @classmethod
+    def from_labels(cls, names, labels, organ_volumes):
+        """
+        Parameters
+        ----------
+        names : Organ names, in bit order
+        labels : Labelled organ volume
+        organ_volumes : Voxel count of every organ
+        Returns
+        -------
+        organ_piv : OrganPIV built from precomputed labels, e.g. attached from shared memory.
+        """
+        organ_piv = cls.__new__(cls)
+        organ_piv.names = list(names)
+        organ_piv.labels = labels
+        organ_piv.organ_volumes = np.asarray(organ_volumes, dtype=float)
+        return organ_piv
+
+    def irradiated_volumes(self, lines):
+        """
+        Parameters
+        ----------
+        lines : BeamMask or BeamPath, or array showing the beam path for specific angles
+        Returns
+        -------
+        perc_oar_vols : Dictionary of organ name to percentage volume overlap of the irradiated organ.
+        """
+        if isinstance(lines, BeamPath):
+            lines = lines.mask()
+        if isinstance(lines, BeamMask):
+            beam_labels = lines.gather(self.labels)
+        else:
+            beam_labels = self.labels[lines >= 1]
+        if len(self.names) <= 16:
+            combination_counts = np.bincount(beam_labels.astype(np.intp), minlength=1 << len(self.names))
+            codes = np.flatnonzero(combination_counts)
+            counts = combination_counts[codes]
+        else:
+            codes, counts = np.unique(beam_labels, return_counts=True)
+        membership = (codes.astype(np.int64)[:, None] >> np.arange(len(self.names))) & 1
+        oar_beam_volumes = counts @ membership
+        with np.errstate(divide='ignore', invalid='ignore'):
+            perc_oar_vols = np.where(oar_beam_volumes > 0, oar_beam_volumes / self.organ_volumes * 100, 0)
+        return dict(zip(self.names, perc_oar_vols.tolist()))
+
+
+def generate_geometries(couch_range=range(-90, 91, 15), gantry_range=range(0, 360, 10)):
+    """
+    Parameters
+    ----------
+    couch_range : Couch angles in degrees
+    gantry_range : Gantry angles in degrees
+    Returns
+    -------
+    geometries : List of (couch angle, gantry angle) pairs, couch angle in the outer loop.
+    """
+    return [(couch_angle, gantry_angle % 360) for couch_angle in couch_range for gantry_angle in gantry_range]
+
+
+def evaluate_geometry(couch_angle, gantry_angle, tumor, ct_stack, ref_ct, oars, cache=None, timer=None):
+    """
+    Parameters
+    ----------
+    couch_angle : Couch Angle in degrees
+    gantry_angle : Gantry Angle in degrees
+    tumor : A 3D array describing tumor coordinates
+    ct_stack : A (phases, Z, Y, X) array of the RSP 4DCT, see stack_phases
+    ref_ct : 3D array of the reference RSP CT scan
+    oars : OrganPIV, or dictionary of OAR name to OAR array
+    cache : Optional BeamGeometryCache used to skip ray tracing for known geometries
+    timer : Optional StageTimer, see main; also records the 'wepl' and 'piv' stages
+    Returns
+    -------
+    row : Dictionary with the beam geometry, the PIV of every OAR ('beam_<name>') and the 
+          mean, maximum and minimum over the phases of the mean absolute ΔWEPL.
+    """
+    if timer is None:
+        timer = StageTimer()
+    beam_path, distance, lines = main(tumor, couch_angle, gantry_angle, cache=cache, timer=timer)
+    with timer.stage('wepl'):
+        ref_wepl, eval_wepls, dif_phase_wepl = calculate_phase_wepl(ct_stack, ref_ct, beam_path, distance)
+    dif_phase_mean_wepl = np.mean(np.abs(dif_phase_wepl), axis=1)
+    row = {'couch_angle': couch_angle, 'gantry_angle': gantry_angle}
+    if not isinstance(oars, OrganPIV):
+        oars = OrganPIV(oars)
+    with timer.stage('piv'):
+        for oar_name, perc_oar_vol in oars.irradiated_volumes(beam_path).items():
+            row['beam_' + oar_name] = perc_oar_vol
+    row['wepl'] = np.mean(dif_phase_mean_wepl)
+    row['max_wepl'] = np.max(dif_phase_mean_wepl)
+    row['min_wepl'] = np.min(dif_phase_mean_wepl)
+    return row
+
+
+def _release_shared_blocks(blocks):
+    for block in blocks:
+        block.close()
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+    blocks.clear()
+
+
+class SharedVolumeStore:
+    """
+    Holds volumes in named shared memory blocks so worker processes can attach to them 
+    as read-only NumPy views instead of receiving a pickled copy each. Volumes that are 
+    already memory-mapped from a file (e.g. by open_volume_container) are not copied; the 
+    workers map the same file instead and only read the pages they need. The blocks are 
+    released when the store is closed, when its with-block exits (including on an 
+    interrupted sweep) or at interpreter exit.
+    """
+
+    def __init__(self):
+        self._blocks = []
+        self._finalizer = weakref.finalize(self, _release_shared_blocks, self._blocks)
+
+    def put(self, array):
+        """
+        Parameters
+        ----------
+        array : Array to be copied into shared memory, or a memory-mapped array
+        Returns
+        -------
+        handle : Picklable handle to pass to attach_volumes, with the shared memory block 
+                 or the mapped file of the volume, its shape and dtype.
+        """
+        # Only a memmap whose buffer is the mapping itself starts at its recorded offset; 
+        # views into a memmap are copied like any other array
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename:
+            order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+            return ('mapped_volume', array.filename, array.offset, array.shape, array.dtype.str, order)
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return ('shared_volume', block.name, array.shape, array.dtype.str)
+
+    def share(self, volumes):
+        """
+        Parameters
+        ----------
+        volumes : Array, or (nested) dictionary of arrays, to be put in shared memory
+        Returns
+        -------
+        handles : The same structure with every array replaced by its handle.
+        """
+        if isinstance(volumes, dict):
+            return {name: self.share(volume) for name, volume in volumes.items()}
+        return self.put(volumes)
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_attached_blocks = []
+
+
+def attach_volumes(handles):
+    """
+    Parameters
+    ----------
+    handles : Handle, or (nested) dictionary of handles, from SharedVolumeStore.share
+    Returns
+    -------
+    volumes : The same structure with every handle replaced by a read-only view of the volume.
+    """
+    if isinstance(handles, dict):
+        return {name: attach_volumes(handle) for name, handle in handles.items()}
+    if handles[0] == 'mapped_volume':
+        _, filename, offset, shape, dtype, order = handles
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+    _, block_name, shape, dtype = handles
+    block = shared_memory.SharedMemory(name=block_name)
+    _attached_blocks.append(block)
+    volume = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    volume.flags.writeable = False
+    return volume
+
+
+_sweep_state = {}
+
+
+def _init_sweep_worker(handles, organ_names, organ_volumes, cache):
+    _sweep_state.update(attach_volumes(handles))
+    _sweep_state['oars'] = OrganPIV.from_labels(organ_names, _sweep_state.pop('organ_labels'), organ_volumes)
+    _sweep_state['cache'] = cache
+
+
+def evaluate_sweep_task(geometry, tumor, ct_stack, ref_ct, oars, cache=None):
+    """
+    Returns
+    -------
+    row : Row of the geometry, see evaluate_geometry
+    record : StageTimer record of the evaluation, see StageLog
+    """
+    couch_angle, gantry_angle = geometry
+    timer = StageTimer(couch_angle=couch_angle, gantry_angle=gantry_angle)
+    with timer.stage('total'):
+        row = evaluate_geometry(*geometry, tumor, ct_stack, ref_ct, oars, cache=cache, timer=timer)
+    timer.record['peak_memory_mb'] = peak_memory_mb()
+    timer.record['pid'] = os.getpid()
+    return row, timer.record
+
+
+def _evaluate_sweep_task(geometry):
+    return evaluate_sweep_task(geometry, **_sweep_state)
+
+
+@contextlib.contextmanager
+def sweep_pool(tumor, ct_stack, ref_ct, oars, workers=None, cache=None):
+    """
+    Pool of worker processes attached to the volumes of a patient in shared memory, to run 
+    several sweeps (e.g. the rounds of run_adaptive_angle_sweep) without starting the 
+    workers and sharing the volumes again for each.
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    ct_stack : A (phases, Z, Y, X) array of the RSP 4DCT, see stack_phases
+    ref_ct : 3D array of the reference RSP CT scan
+    oars : OrganPIV, or dictionary of OAR name to OAR array
+    workers : Number of worker processes. None uses all CPUs; 1 runs serially in this process.
+    cache : Optional BeamGeometryCache used by the workers to skip ray tracing for known geometries
+    Yields
+    ------
+    executor : ProcessPoolExecutor to pass to run_angle_sweep, or None if workers is 1.
+    """
+    organ_piv = oars if isinstance(oars, OrganPIV) else OrganPIV(oars)
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1:
+        yield None
+        return
+    volumes = {'tumor': tumor, 'ct_stack': ct_stack, 'ref_ct': ref_ct, 'organ_labels': organ_piv.labels}
+    # Workers attach to the volumes in shared memory rather than each receiving a copy
+    with SharedVolumeStore() as store, \
+         ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker, 
+                             initargs=(store.share(volumes), organ_piv.names, 
+                                       organ_piv.organ_volumes, cache)) as executor:
+        yield executor
+
+
+def run_angle_sweep(geometries, tumor, ct_stack, ref_ct, oars, workers=None, cache=None, stage_log=None, executor=None):
+    """
+    Evaluate every beam geometry, spread over a pool of worker processes.
+    Parameters
+    ----------
+    geometries : List of (couch angle, gantry angle) pairs, see generate_geometries
+    tumor : A 3D array describing tumor coordinates
+    ct_stack : A (phases, Z, Y, X) array of the RSP 4DCT, see stack_phases
+    ref_ct : 3D array of the reference RSP CT scan
+    oars : OrganPIV, or dictionary of OAR name to OAR array
+    workers : Number of worker processes. None uses all CPUs; 1 runs serially in this 
+              process, which is easier to debug.
+    cache : Optional BeamGeometryCache used to skip ray tracing for known geometries
+    stage_log : Optional StageLog the stage timings and counts of every evaluation are added to
+    executor : Optional pool from sweep_pool opened on the same volumes, oars and cache, used 
+               instead of starting a new one; workers is then ignored
+    Returns
+    -------
+    df : Dataframe with one row per geometry, in the order of geometries, indexed by couch angle.
+    """
+    # Organ labels and volumes are computed once for the whole sweep
+    organ_piv = oars if isinstance(oars, OrganPIV) else OrganPIV(oars)
+    if executor is not None:
+        pool = contextlib.nullcontext(executor)
+    else:
+        pool = sweep_pool(tumor, ct_stack, ref_ct, organ_piv, workers, cache)
+    with pool as executor:
+        if executor is None:
+            results = [evaluate_sweep_task(geometry, tumor, ct_stack, ref_ct, organ_piv, cache=cache) 
+                       for geometry in geometries]
+        else:
+            # map returns results in submission order, so the rows keep the order of geometries
+            results = list(executor.map(_evaluate_sweep_task, geometries))
+    if stage_log is not None:
+        stage_log.extend(record for row, record in results)
+    df = pd.DataFrame([row for row, record in results])
+    df.index = df['couch_angle'].to_numpy()
+    return df
+
+
+def final_z_score(df, weights):
+    """
+    Parameters
+    ----------
+    df : Dataframe of a sweep, see run_angle_sweep
+    weights : Dictionary of column name (e.g. 'wepl', 'beam_heart') to its weighting factor
+    Returns
+    -------
+    z_score : Weighted sum of the z-scores of the columns. Columns that are constant over the 
+              sweep (e.g. an organ never irradiated) contribute nothing.
+    """
+    z_score = np.zeros(len(df))
+    for column, weight in weights.items():
+        z_score += np.nan_to_num(stats.zscore(df[column])) * weight
+    return z_score
+
+
+def run_adaptive_angle_sweep(tumor, ct_stack, ref_ct, oars, weights, couch_limits=(-90, 90), coarse_steps=(30, 20),
+                             resolution=2.5, budget=468, refine_count=8, workers=None, cache=None, stage_log=None):
+    """
+    Coarse-to-fine sweep: a coarse couch/gantry grid is evaluated first, then in every 
+    round the refine_count lowest Final z-score geometries that are not yet at the target 
+    resolution get their 8 neighbours at half their grid step evaluated, until no 
+    geometry can be refined or the budget of evaluated geometries is spent. The coarse grid 
+    and every neighbourhood are evaluated whole, never cut to fit the budget, so no couch 
+    or gantry angles of a grid are left out.
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    ct_stack : A (phases, Z, Y, X) array of the RSP 4DCT, see stack_phases
+    ref_ct : 3D array of the reference RSP CT scan
+    oars : OrganPIV, or dictionary of OAR name to OAR array
+    weights : Weighting factors of the Final z-score, see final_z_score
+    couch_limits : Lowest and highest couch angle in degrees
+    coarse_steps : Couch and gantry step of the coarse grid in degrees
+    resolution : Finest couch and gantry step in degrees
+    budget : Maximum number of geometries evaluated, including the coarse grid, which must 
+             fit in it. A geometry whose neighbours no longer fit is not refined.
+    refine_count : Number of geometries refined per round
+    workers : Number of worker processes, see run_angle_sweep
+    cache : Optional BeamGeometryCache used to skip ray tracing for known geometries
+    stage_log : Optional StageLog, see run_angle_sweep
+    Returns
+    -------
+    df : Dataframe with one row per evaluated geometry, with the columns of run_angle_sweep, 
+         in evaluation order and indexed by couch angle.
+    """
+    organ_piv = oars if isinstance(oars, OrganPIV) else OrganPIV(oars)
+    couch_limits = (float(couch_limits[0]), float(couch_limits[1]))
+    coarse_geometries = generate_geometries(np.arange(couch_limits[0], couch_limits[1] + 1e-9, coarse_steps[0]), 
+                                            np.arange(0, 360, coarse_steps[1]))
+    if budget < len(coarse_geometries):
+        raise ValueError('The budget of {} geometries is smaller than the coarse grid of {}'.format(
+            budget, len(coarse_geometries)))
+    # Grid step of every geometry to be evaluated, and of every geometry evaluated
+    new_steps = {(float(couch_angle), float(gantry_angle)): tuple(coarse_steps) for couch_angle, gantry_angle in coarse_geometries}
+    steps = {}
+    refined = set()
+    frames = []
+    # One pool serves every round, so the workers start and the volumes are shared only once
+    with sweep_pool(tumor, ct_stack, ref_ct, organ_piv, workers, cache) as executor:
+        while new_steps and len(steps) < budget:
+            geometries = list(new_steps)
+            for geometry in geometries:
+                steps[geometry] = new_steps[geometry]
+            frames.append(run_angle_sweep(geometries, tumor, ct_stack, ref_ct, organ_piv, workers, cache, 
+                                          stage_log=stage_log, executor=executor))
+            df = pd.concat(frames)
+            # Refine around the geometries with the lowest Final z-score so far
+            new_steps = {}
+            refine_rounds = 0
+            for position in np.argsort(final_z_score(df, weights), kind='stable'):
+                if refine_rounds == refine_count:
+                    break
+                geometry = (df['couch_angle'].iat[position], df['gantry_angle'].iat[position])
+                if geometry in refined or max(steps[geometry]) <= resolution:
+                    continue
+                step = (max(steps[geometry][0] / 2, resolution), max(steps[geometry][1] / 2, resolution))
+                neighbours = []
+                for couch_offset in (-step[0], 0, step[0]):
+                    for gantry_offset in (-step[1], 0, step[1]):
+                        neighbour = (round(geometry[0] + couch_offset, 6), round((geometry[1] + gantry_offset) % 360, 6))
+                        if couch_limits[0] <= neighbour[0] <= couch_limits[1] and neighbour not in steps \
+                                and neighbour not in new_steps:
+                            neighbours.append(neighbour)
+                # Only whole neighbourhoods are evaluated, a partial one would be cut in couch order
+                if len(steps) + len(new_steps) + len(neighbours) > budget:
+                    continue
+                refined.add(geometry)
+                refine_rounds += 1
+                for neighbour in neighbours:
+                    new_steps[neighbour] = step
+    return pd.concat(frames)
+
+
 def central_angle(ca1,ga1,ca2,ga2):
     """
     Parameters
@@ -243,6 +1313,94 @@ def has_central_angle_diff(ca1, ga1, ca2, ga2,df):
     """
     return central_angle(ca1, ga1, ca2, ga2) >= df
 
+def central_angle_matrix(couch_angles, gantry_angles):
+    """
+    Parameters
+    ----------
+    couch_angles : Couch angles of the beam geometries
+    gantry_angles : Gantry angles of the beam geometries
+    Returns
+    -------
+    ds : (N, N) array of the central angle between every pair of beam geometries, from 
+         central_angle broadcast over all pairs at once.
+    """
+    couch_angles = np.asarray(couch_angles, dtype=float)
+    gantry_angles = np.asarray(gantry_angles, dtype=float)
+    return central_angle(couch_angles[:, None], gantry_angles[:, None], couch_angles[None, :], gantry_angles[None, :])
+
+
+def find_optimal_combinations(couch_angles, gantry_angles, z_scores, n_beams=3, separation=20, top_k=5, pool_size=None):
+    """
+    The top_k combinations of n_beams beam geometries with the lowest summed z-score whose 
+    pairwise central angles are all at least the separation. Geometries are ordered by 
+    z-score and combinations are enumerated depth-first in that order, so a partial 
+    combination is pruned (with every later one at the same depth) as soon as its score 
+    plus the lowest scores still available can not beat the worst of the top_k kept in a 
+    bounded heap.
+    Parameters
+    ----------
+    couch_angles : Couch angles of the candidate beam geometries
+    gantry_angles : Gantry angles of the candidate beam geometries
+    z_scores : Final z-score of every candidate geometry
+    n_beams : Number of beams N of each combination
+    separation : Imposed Beam Separation in Degrees
+    top_k : Number of best combinations returned
+    pool_size : Optional number of lowest z-score geometries searched; None searches all
+    Returns
+    -------
+    combinations : A list of up to top_k (summed z-score, [(couch angle, gantry angle), ...]) 
+                   tuples in ascending z-score order. Beams of a combination are listed in 
+                   ascending z-score order.
+    """
+    couch_angles = np.asarray(couch_angles, dtype=float)
+    gantry_angles = np.asarray(gantry_angles, dtype=float)
+    z_scores = np.asarray(z_scores, dtype=float)
+    order = np.argsort(z_scores, kind='stable')
+    if pool_size is not None:
+        order = order[:pool_size]
+    scores = z_scores[order]
+    allowed = central_angle_matrix(couch_angles[order], gantry_angles[order]) >= separation
+    # Max-heap of the best combinations found, as (-z, -found order, combination)
+    heap = []
+    found = [0]
+
+    def worst_kept():
+        return -heap[0][0] if len(heap) == top_k else np.inf
+
+    def keep(z_value, combination):
+        found[0] += 1
+        heapq.heappush(heap, (-z_value, -found[0], combination))
+        if len(heap) > top_k:
+            heapq.heappop(heap)
+
+    def search(chosen, partial, candidates):
+        remaining = n_beams - len(chosen)
+        if remaining == 1:
+            # Candidates are in ascending score order, so only the first top_k can be kept
+            for candidate in candidates[:top_k]:
+                z_value = partial + scores[candidate]
+                if z_value >= worst_kept():
+                    break
+                keep(z_value, chosen + [candidate])
+            return
+        for position in range(len(candidates) - remaining + 1):
+            # Lowest possible score of any combination continuing from this candidate
+            bound = partial + np.sum(scores[candidates[position:position + remaining]])
+            if bound - 1e-9 >= worst_kept():
+                break
+            candidate = candidates[position]
+            later = candidates[position + 1:]
+            search(chosen + [candidate], partial + scores[candidate], later[allowed[candidate, later]])
+
+    if 0 < n_beams <= len(scores) and top_k > 0:
+        search([], 0.0, np.arange(len(scores)))
+    combinations = []
+    for negative_z, _, combination in sorted(heap, key=lambda entry: (-entry[0], -entry[1])):
+        combinations.append((-negative_z, [(couch_angles[order[index]], gantry_angles[order[index]]) 
+                                           for index in combination]))
+    return combinations
+
+
 """
 Functions end 
 """
\ No newline at end of file
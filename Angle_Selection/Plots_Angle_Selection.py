@@ -27,9 +27,10 @@ dz = pd.read_csv('p104_z_score_data.csv')
 Visualise Beam path
 """
 # Generate Beam for couch angle 0 and gantry angle 45#
-lines_coords,distance, lines = main(tumor , 0 ,45)
+beam_path,distance, lines = main(tumor , 0 ,45)
 # Mask Beam and Tumour
 tumor_masked = np.ma.masked_where(tumor == 0, tumor)
+lines = lines.to_dense()
 beam = np.ma.masked_where(lines == 0, lines)
 # Plot CT scan and beam
 plt.imshow(ref_ave_ct[45,:,:], cmap='gray')
@@ -0,0 +1,273 @@
+"""
+@author: Kyriakos Fotiou
+"""
+import os
+import sys
+import io
+import json
+import time
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+import numpy as np
+
+# The pipeline modules live in the two algorithm folders next to this one
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('4DCT_Pre_Processing', 'Angle_Selection'):
+    if os.path.join(repository, folder) not in sys.path:
+        sys.path.insert(0, os.path.join(repository, folder))
+
+from Functions_Pre_Processing import (generate_ct_maps, stream_ct_maps, transform_HU_to_RSP, 
+                                      transform_Single_CT_HU_to_RSP, generate_itv_ctv_ictv, generate_itv_ctv_ictv_edt, 
+                                      generate_oar_maps, load_calibration)
+from Functions_Angle_Selection import (generate_steps, get_distal_edge_point, generate_lines, generate_beam_path, 
+                                       BeamPath, calculate_distances, calculate_beam_wepl, calculate_phase_wepl, 
+                                       stack_phases, oar_irradiated_vol, OrganPIV, generate_geometries, 
+                                       find_optimal_combinations)
+
+"""
+Synthetic 4DCT phantom
+"""
+
+def breathing_displacement(phase, phases, amplitude):
+    """
+    Parameters
+    ----------
+    phase : Index of the breathing phase
+    phases : Number of phases of the breathing cycle
+    amplitude : Peak-to-peak motion amplitude in mm
+    Returns
+    -------
+    displacement : Inferior displacement in mm, 0 at phase 0 (end of exhale) and the
+                   amplitude half way through the cycle.
+    """
+    return amplitude * (1 - np.cos(2 * np.pi * phase / phases)) / 2
+
+
+def generate_phantom(shape=(40, 128, 128), phases=10, tumor_radius=15, amplitude=10,
+                     voxel_size=(3.0,1.0527,1.0527), noise=10, seed=0):
+    """
+    Breathing thorax phantom: an elliptical body with two lungs, a heart, a spinal canal
+    inside a vertebra and a spherical tumour in the right lung. The lung bases, the heart
+    and the tumour move inferiorly with the breathing cycle; the tumour follows it fully,
+    the heart with half the amplitude.
+    Parameters
+    ----------
+    shape : (Z, Y, X) grid size of every phase
+    phases : Number of phases of the 4DCT
+    tumor_radius : Radius of the tumour in mm
+    amplitude : Peak-to-peak superior-inferior motion amplitude of the tumour in mm
+    voxel_size : Voxel dimensions of the CT scan
+    noise : Standard deviation of the Gaussian noise added to the CT in HU
+    seed : Seed of the noise
+    Returns
+    -------
+    phantom : Dictionary with the lists of phases 'ct' (int16 HU), 'tumor', 'heart', 'cord',
+              'rlung' and 'llung' (boolean masks), like the folders of a patient.
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = [(np.arange(size) - (size - 1) / 2) * spacing for size, spacing in zip(shape, voxel_size)]
+    z, y, x = z[:, None, None], y[None, :, None], x[None, None, :]
+    # Body half-axes in mm; anterior is -y, the patient's right is -x
+    body_y, body_x = 0.4 * shape[1] * voxel_size[1], 0.45 * shape[2] * voxel_size[2]
+    height = shape[0] * voxel_size[0]
+    body = np.broadcast_to((y / body_y)**2 + (x / body_x)**2 <= 1, shape)
+    cord = np.broadcast_to((y - 0.7 * body_y)**2 + x**2 <= 5**2, shape)
+    vertebra = np.broadcast_to((y - 0.7 * body_y)**2 + x**2 <= 15**2, shape) & ~cord
+    phantom = {name: [] for name in ('ct', 'tumor', 'heart', 'cord', 'rlung', 'llung')}
+    for phase in range(phases):
+        displacement = breathing_displacement(phase, phases, amplitude)
+        lungs = {}
+        for name, side in (('rlung', -1), ('llung', 1)):
+            # The apex stays put while the base follows the diaphragm
+            half_height = 0.4 * height + displacement / 2
+            centre_z = 0.45 * height - half_height
+            lungs[name] = (((z - centre_z) / half_height)**2 + ((y + 0.05 * body_y) / (0.6 * body_y))**2 +
+                           ((x - side * 0.45 * body_x) / (0.35 * body_x))**2 <= 1)
+        heart = (((z + 0.2 * height + displacement / 2) / (0.2 * height))**2 + ((y + 0.3 * body_y) / (0.3 * body_y))**2 +
+                 ((x - 0.15 * body_x) / (0.3 * body_x))**2 <= 1) & ~lungs['llung']
+        tumor = ((z + displacement)**2 + (y + 0.05 * body_y)**2 + (x + 0.45 * body_x)**2 <= tumor_radius**2)
+        ct = np.full(shape, -1000, dtype=np.float32)
+        ct[body] = 0
+        ct[lungs['rlung'] | lungs['llung']] = -800
+        ct[heart] = 40
+        ct[vertebra] = 700
+        ct[cord] = 30
+        ct[tumor] = 30
+        ct += rng.normal(0, noise, shape).astype(np.float32)
+        phantom['ct'].append(np.rint(ct).astype(np.int16))
+        phantom['tumor'].append(tumor)
+        phantom['heart'].append(heart)
+        phantom['cord'].append(np.array(cord))
+        phantom['rlung'].append(lungs['rlung'] & ~tumor)
+        phantom['llung'].append(lungs['llung'])
+    return phantom
+
+
+"""
+Stage benchmarks
+"""
+
+def benchmark_stage(function, items, unit, repeat=3):
+    """
+    Times a stage repeat times and measures its peak memory in one further run traced
+    with tracemalloc, which is kept out of the timed runs as it slows allocations down.
+    The console output of the stage is discarded.
+    Parameters
+    ----------
+    function : Callable without arguments running the stage once
+    items : Number of items (voxels, rays, ...) processed by one run, for the throughput
+    unit : Name of the items
+    repeat : Number of timed runs
+    Returns
+    -------
+    result : Dictionary with the best and mean wall time in seconds, the items, the
+             throughput in items per second of the best run and the peak memory in MB.
+    output : Return value of the last run of the stage.
+    """
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = function()
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            output = function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    best = min(seconds)
+    result = {'seconds': best,
+              'mean_seconds': float(np.mean(seconds)),
+              'items': int(items),
+              'unit': unit,
+              'throughput': items / best if best > 0 else float('inf'),
+              'peak_memory_mb': peak / 1024**2}
+    return result, output
+
+
+def run_benchmarks(shape=(40, 128, 128), phases=10, tumor_radius=15, amplitude=10, voxel_size=(3.0,1.0527,1.0527),
+                   expansion_magnitude=5, geometries=None, repeat=3, seed=0):
+    """
+    Generates a phantom and benchmarks every stage of the pipeline on it, each stage on the
+    outputs of the previous ones. The engines the scripts run (stream_ct_maps, 
+    HUToRSPCalibration.convert, generate_beam_path, calculate_phase_wepl and OrganPIV) are 
+    timed next to the list-based functions of the original pipeline, which are kept for 
+    comparison.
+    Parameters
+    ----------
+    shape : (Z, Y, X) grid size of the phantom
+    phases : Number of phases of the phantom 4DCT
+    tumor_radius : Radius of the tumour in mm
+    amplitude : Motion amplitude of the tumour in mm
+    voxel_size : Voxel dimensions of the CT scan
+    expansion_magnitude : CTV margin in mm
+    geometries : List of (couch angle, gantry angle) pairs the beam stages are run for.
+                 Defaults to 18 geometries at 90 degrees couch by 60 degrees gantry steps.
+    repeat : Number of timed runs of every stage
+    seed : Seed of the phantom noise and of the z-scores of the triplet search
+    Returns
+    -------
+    results : Dictionary with the 'config', the 'environment', the 'phantom' sizes and the
+              'stages', see benchmark_stage. Beam stages also record their counts.
+    """
+    if geometries is None:
+        geometries = generate_geometries(range(-90, 91, 90), range(0, 360, 60))
+    config = {'shape': list(shape), 'phases': phases, 'tumor_radius': tumor_radius, 'amplitude': amplitude,
+              'voxel_size': list(voxel_size), 'expansion_magnitude': expansion_magnitude,
+              'geometries': [list(geometry) for geometry in geometries], 'repeat': repeat, 'seed': seed}
+    start = time.perf_counter()
+    phantom = generate_phantom(shape, phases, tumor_radius, amplitude, voxel_size, seed=seed)
+    phantom_seconds = time.perf_counter() - start
+    calibration = load_calibration()
+    voxels = int(np.prod(shape))
+    stages = {}
+
+    stages['generate_ct_maps'], (ct_ave, ct_mip, ct_min_ip) = benchmark_stage(
+        lambda: generate_ct_maps(phantom['ct']), voxels * phases, 'voxels', repeat)
+    with tempfile.TemporaryDirectory() as folder:
+        # The streaming pass reads the phases from disk like the batch pre-processing does
+        phase_paths = []
+        for phase, ct in enumerate(phantom['ct']):
+            phase_paths.append(os.path.join(folder, 'phase_{}.npy'.format(phase)))
+            np.save(phase_paths[-1], ct)
+        stages['stream_ct_maps'], _ = benchmark_stage(
+            lambda: stream_ct_maps(phase_paths, calibration=calibration), voxels * phases, 'voxels', repeat)
+    stages['transform_HU_to_RSP'], rsp_list = benchmark_stage(
+        lambda: transform_HU_to_RSP(phantom['ct'], calibration), voxels * phases, 'voxels', repeat)
+    rsp_out = np.empty(shape, dtype=np.float32)
+    stages['HUToRSPCalibration.convert int16'], _ = benchmark_stage(
+        lambda: [calibration.convert(ct, out=rsp_out) for ct in phantom['ct']], voxels * phases, 'voxels', repeat)
+    # The AIP is the float32 input of the reference RSP CT
+    stages['HUToRSPCalibration.convert float32'], _ = benchmark_stage(
+        lambda: calibration.convert(ct_ave, out=rsp_out), voxels, 'voxels', repeat)
+    stages['generate_itv_ctv_ictv'], (itv, ctv_list, ictv) = benchmark_stage(
+        lambda: generate_itv_ctv_ictv(phantom['tumor'], voxel_size, expansion_magnitude), voxels * phases, 'voxels', repeat)
+    stages['generate_itv_ctv_ictv_edt'], _ = benchmark_stage(
+        lambda: generate_itv_ctv_ictv_edt(phantom['tumor'], voxel_size, expansion_magnitude, workers=1),
+        voxels * phases, 'voxels', repeat)
+    tumor = ictv.astype(int)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ref_rsp = transform_Single_CT_HU_to_RSP(ct_ave, calibration)
+        oars = {name: generate_oar_maps(phantom[name]) for name in ('heart', 'cord', 'rlung', 'llung')}
+        steps = [generate_steps(gantry_angle, couch_angle, [0,-1,0]) for couch_angle, gantry_angle in geometries]
+    stages['get_distal_edge_point'], distal = benchmark_stage(
+        lambda: [get_distal_edge_point(tumor, step) for step in steps], len(geometries), 'geometries', repeat)
+    distal_points = [points for points, distal_array in distal]
+    rays = sum(len(points) for points in distal_points)
+    stages['get_distal_edge_point']['distal_points'] = rays
+    stages['generate_lines'], lines = benchmark_stage(
+        lambda: [generate_lines(tumor, points, step) for points, step in zip(distal_points, steps)], rays, 'rays', repeat)
+    beam_paths = [BeamPath.from_lines_coords(shape, lines_coords, voxel_size) for beam_lines, lines_coords in lines]
+    distances = [calculate_distances(beam_path) for beam_path in beam_paths]
+    ray_voxels = sum(len(beam_path.indices) for beam_path in beam_paths)
+    stages['generate_lines']['ray_voxels'] = ray_voxels
+    stages['calculate_beam_wepl'], _ = benchmark_stage(
+        lambda: [calculate_beam_wepl(ct, beam_path, distance) for beam_path, distance in zip(beam_paths, distances)
+                 for ct in [ref_rsp] + rsp_list], ray_voxels * (phases + 1), 'voxels', repeat)
+    stages['oar_irradiated_vol'], _ = benchmark_stage(
+        lambda: [oar_irradiated_vol(oar, beam_lines, name) for beam_lines, lines_coords in lines
+                 for name, oar in oars.items()], len(geometries) * len(oars), 'organ evaluations', repeat)
+    stages['generate_beam_path'], traced = benchmark_stage(
+        lambda: [generate_beam_path(tumor, points, step, voxel_size) for points, step in zip(distal_points, steps)],
+        rays, 'rays', repeat)
+    beam_paths = [beam_path for beam_mask, beam_path in traced]
+    ct_stack = stack_phases(rsp_list)
+    stages['calculate_phase_wepl'], _ = benchmark_stage(
+        lambda: [calculate_phase_wepl(ct_stack, ref_rsp, beam_path) for beam_path in beam_paths],
+        ray_voxels * (phases + 1), 'voxels', repeat)
+    organ_piv = OrganPIV(oars)
+    stages['OrganPIV.irradiated_volumes'], _ = benchmark_stage(
+        lambda: [organ_piv.irradiated_volumes(beam_mask) for beam_mask, beam_path in traced],
+        len(geometries) * len(oars), 'organ evaluations', repeat)
+
+    # The combination search runs on the full clinical grid with synthetic z-scores
+    grid = generate_geometries()
+    couch_angles, gantry_angles = np.array(grid, dtype=float).T
+    z_scores = np.random.default_rng(seed).normal(size=len(grid))
+    stages['find_optimal_combinations'], _ = benchmark_stage(
+        lambda: find_optimal_combinations(couch_angles, gantry_angles, z_scores, n_beams=3, top_k=5), 
+        len(grid), 'geometries', repeat)
+
+    environment = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                   'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                   'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    phantom_sizes = {'voxels': voxels, 'tumor_voxels': int(np.count_nonzero(tumor)),
+                     'seconds': phantom_seconds}
+    return {'config': config, 'environment': environment, 'phantom': phantom_sizes, 'stages': stages}
+
+
+def write_benchmark_results(results, path):
+    """
+    Parameters
+    ----------
+    results : Dictionary returned by run_benchmarks
+    path : JSON file the results are written to
+    Returns
+    -------
+    None.
+    """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
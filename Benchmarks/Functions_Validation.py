@@ -0,0 +1,274 @@
+"""
+@author: Kyriakos Fotiou
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+
+# The pipeline modules live in the two algorithm folders next to this one
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('4DCT_Pre_Processing', 'Angle_Selection'):
+    if os.path.join(repository, folder) not in sys.path:
+        sys.path.insert(0, os.path.join(repository, folder))
+
+from Functions_Angle_Selection import (get_distal_edge_point, generate_lines, has_central_angle_diff,
+                                       central_angle_matrix, find_optimal_combinations)
+from Functions_Angle_Selection import open_volume_container, uncrop_volume
+from Functions_Pre_Processing import patient_directories, run_pre_processing, load_calibration
+
+"""
+Original implementations of the rewritten engines and the parity checks between them
+"""
+
+def get_distal_edge_point_reference(tumor, steps, threshold=40):
+    """
+    Original voxel-by-voxel distal edge search of the Angle Selection Algorithm, the 
+    reference get_distal_edge_point is checked against.
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    steps : Steps that will define the direction of the beam based on the angle combinations. 
+    threshold : Threshold to limit the binary search so the code does not run forever
+    Returns
+    -------
+    distal_points : A list of all the distal edge points coordinates
+    distal_array : A 3D array representing the distal edge.
+    """
+    distal_points = []
+    distal_array = np.zeros_like(tumor)
+    z_step, y_step, x_step = steps
+    for i in range(tumor.shape[0]):
+        for j in range(tumor.shape[1]):
+            for k in range(tumor.shape[2]):
+                if tumor[i, j, k] == 1:
+                    z, y, x = i - z_step, j - y_step, k - x_step
+                    count = 0
+                    is_distal_edge = False
+                    while z >= 0 and int(np.round(z)) < tumor.shape[0] and y >= 0 and int(np.round(y)) < tumor.shape[1] and x >= 0 and int(np.round(x)) < tumor.shape[2] and count < threshold:
+                        z_round, y_round, x_round = int(np.round(z)),int(np.round(y)),int(np.round(x))
+                        if tumor[z_round, y_round, x_round] == 0:
+                            break
+                        if tumor[z_round, y_round, x_round] == 1:
+                            is_distal_edge = True
+                        count += 1
+                        z, y, x = z - z_step, y - y_step, x - x_step
+                    if is_distal_edge and count < threshold:
+                        z, y, x = int(z), int(y), int(x)
+                        distal_points.append((z, y, x))
+                        distal_array[z,y,x] = 1
+            distal_points =[*set(distal_points)]
+    return distal_points , distal_array
+
+
+def check_distal_edge_parity(tumor, steps, threshold=40):
+    """
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    steps : Steps that will define the direction of the beam based on the angle combinations. 
+    threshold : Threshold to limit the binary search so the code does not run forever
+    Returns
+    -------
+    parity : True if the vectorised and reference searches find the same distal points and distal array.
+    """
+    distal_points, distal_array = get_distal_edge_point(tumor, steps, threshold)
+    ref_points, ref_array = get_distal_edge_point_reference(tumor, steps, threshold)
+    parity = set(distal_points) == set(ref_points) and np.array_equal(distal_array, ref_array)
+    return parity
+
+
+def generate_lines_reference(tumor, distal_points, steps):
+    """
+    Original ray-by-ray line generation of the Angle Selection Algorithm, the reference 
+    generate_lines is checked against.
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    distal_points : Array representing the distal edge points for the specific angle combinations 
+    steps : Steps that will define the direction of the beam based on the angle combinations
+    Returns
+    -------
+    lines : A 3D array that idicates all the voxels that the beam will pass through
+    lines_coords : A list of arrays that indicate the coordinates from the disatl edge point 
+                   to the last point of the beam before it goes out of bounds
+    """
+    lines_coords = []
+    lines_coords_set = []
+    lines = np.zeros_like(tumor)
+    z_step, y_step, x_step = steps
+    for distal_point in distal_points:
+        i, j, k = distal_point[:3]
+        line_coords = []
+        line_coords_set = set()
+        z, y, x = i,j,k
+        while (0 <= int(z) < tumor.shape[0]) and (0 <= int(y) < tumor.shape[1]) and (0 <= int(x) < tumor.shape[2]):
+            current_point = (int(z), int(y), int(x))
+            if current_point not in line_coords_set:
+                line_coords_set.add(current_point)
+                line_coords.append(current_point)
+            lines[int(z), int(y), int(x)] = 1
+            z += z_step
+            y += y_step
+            x += x_step
+        lines_coords.append(line_coords)
+        lines_coords_set.append(list(line_coords_set))
+    return lines , lines_coords
+
+
+def check_lines_parity(tumor, distal_points, steps):
+    """
+    Parameters
+    ----------
+    tumor : A 3D array describing tumor coordinates
+    distal_points : Array representing the distal edge points for the specific angle combinations 
+    steps : Steps that will define the direction of the beam based on the angle combinations
+    Returns
+    -------
+    parity : True if the batched and reference ray marching produce the same beam mask and 
+             the same voxels for every ray.
+    """
+    lines, lines_coords = generate_lines(tumor, distal_points, steps)
+    ref_lines, ref_lines_coords = generate_lines_reference(tumor, distal_points, steps)
+    parity = np.array_equal(lines, ref_lines) and lines_coords == ref_lines_coords
+    return parity
+
+
+def find_optimal_triplet_reference(couch_angles, gantry_angles, z_scores, separation=20):
+    """
+    Original nested-loop triplet search over every ordered triplet, kept as the reference 
+    for check_triplet_parity.
+    Parameters
+    ----------
+    couch_angles : Couch angles of the candidate beam geometries
+    gantry_angles : Gantry angles of the candidate beam geometries
+    z_scores : Final z-score of every candidate geometry
+    separation : Imposed Beam Separation in Degrees
+    Returns
+    -------
+    min_z : Minimum summed z-score, inf if no triplet satisfies the separation
+    min_combinations : List of the three (couch angle, gantry angle) tuples, or None.
+    """
+    rows = list(zip(np.asarray(couch_angles, dtype=float), np.asarray(gantry_angles, dtype=float), 
+                    np.asarray(z_scores, dtype=float)))
+    min_z = float('inf')
+    min_combinations = None
+    for ca1, ga1, z1 in rows:
+        for ca2, ga2, z2 in rows:
+            for ca3, ga3, z3 in rows:
+                if has_central_angle_diff(ca1, ga1, ca2, ga2, separation) and \
+                    has_central_angle_diff(ca2, ga2, ca3, ga3, separation) and \
+                    has_central_angle_diff(ca3, ga3, ca1, ga1, separation):
+                    z_value = z1 + z2 + z3
+                    if z_value < min_z:
+                        min_combinations = [(ca1, ga1), (ca2, ga2), (ca3, ga3)]
+                        min_z = z_value
+    return min_z, min_combinations
+
+
+def find_optimal_triplet(couch_angles, gantry_angles, z_scores, separation=20):
+    """
+    Vectorised triplet search of the earlier pipeline, kept as the reference for 
+    check_triplet_parity on grids too large for the nested loops. Only unordered triplets 
+    i < j < k of allowed pairs are enumerated, one vectorised block per first geometry.
+    Parameters
+    ----------
+    couch_angles : Couch angles of the candidate beam geometries
+    gantry_angles : Gantry angles of the candidate beam geometries
+    z_scores : Final z-score of every candidate geometry
+    separation : Imposed Beam Separation in Degrees
+    Returns
+    -------
+    min_z : Minimum summed z-score, inf if no triplet satisfies the separation
+    min_combinations : List of the three (couch angle, gantry angle) tuples, or None.
+    """
+    couch_angles = np.asarray(couch_angles, dtype=float)
+    gantry_angles = np.asarray(gantry_angles, dtype=float)
+    z_scores = np.asarray(z_scores, dtype=float)
+    allowed = central_angle_matrix(couch_angles, gantry_angles) >= separation
+    min_z = float('inf')
+    best = None
+    for i in range(len(z_scores)):
+        # Second and third geometries after i that are separated from i and from each other
+        candidates = np.flatnonzero(allowed[i, i + 1:]) + i + 1
+        j, k = np.nonzero(np.triu(allowed[np.ix_(candidates, candidates)], 1))
+        if len(j) == 0:
+            continue
+        j, k = candidates[j], candidates[k]
+        z_values = z_scores[i] + z_scores[j] + z_scores[k]
+        best_pair = np.argmin(z_values)
+        if z_values[best_pair] < min_z:
+            min_z = z_values[best_pair]
+            best = (i, j[best_pair], k[best_pair])
+    if best is None:
+        return min_z, None
+    min_combinations = [(couch_angles[index], gantry_angles[index]) for index in best]
+    return min_z, min_combinations
+
+
+def check_triplet_parity(couch_angles, gantry_angles, z_scores, separation=20, reference=find_optimal_triplet_reference):
+    """
+    Parameters
+    ----------
+    couch_angles : Couch angles of the candidate beam geometries
+    gantry_angles : Gantry angles of the candidate beam geometries
+    z_scores : Final z-score of every candidate geometry
+    separation : Imposed Beam Separation in Degrees
+    reference : Reference triplet search, the original nested loops or find_optimal_triplet 
+                for grids too large for them
+    Returns
+    -------
+    parity : True if the best three-beam combination of find_optimal_combinations and the 
+             reference triplet have the same summed z-score, up to the summation order, and 
+             the same three geometries in any order.
+    """
+    combinations = find_optimal_combinations(couch_angles, gantry_angles, z_scores, n_beams=3, 
+                                             separation=separation, top_k=1)
+    ref_z, ref_combinations = reference(couch_angles, gantry_angles, z_scores, separation)
+    if not combinations or ref_combinations is None:
+        return not combinations and ref_combinations is None
+    min_z, min_combinations = combinations[0]
+    return bool(np.isclose(min_z, ref_z)) and set(map(tuple, min_combinations)) == set(map(tuple, ref_combinations))
+
+
+"""
+Volume container crop
+"""
+
+def check_container_crop(phantom, voxel_size=(3.0,1.0527,1.0527), padding=20):
+    """
+    Runs run_pre_processing on the phantom padded with air in Y and X, so the body crop 
+    shrinks the grid, and checks the container it writes against the input phases.
+    Parameters
+    ----------
+    phantom : Phantom from generate_phantom
+    voxel_size : Voxel dimensions of the CT scan
+    padding : Number of air voxels added on both sides of the Y and X axes
+    Returns
+    -------
+    parity : True if the grid was cropped, the container holds only the files named in its 
+             metadata, the cropped RSP phases and AIP equal those of the padded input inside 
+             the crop box and uncrop_volume restores the padded grid.
+    """
+    pad = ((0, 0), (padding, padding), (padding, padding))
+    ct = [np.pad(phase_ct, pad, constant_values=-1000) for phase_ct in phantom['ct']]
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, dirname in patient_directories('phantom', data_dir).items():
+            os.makedirs(dirname)
+            for phase, array in enumerate(ct if name == 'ct' else phantom[name]):
+                np.save(os.path.join(dirname, 'phase_{}.npy'.format(phase)), 
+                        array if name == 'ct' else np.pad(array, pad))
+        # The returned arrays are not kept, so no map of the container outlives the directory
+        run_pre_processing('phantom', data_dir, data_dir, voxel_size=voxel_size, workers=1)
+        container = os.path.join(data_dir, 'phantom_volumes')
+        volumes, metadata = open_volume_container(container, mmap_mode=None)
+        files = set(os.listdir(container)) == {info['file'] for info in metadata['arrays'].values()} | {'metadata.json'}
+    offset = metadata['crop']['offset']
+    box = tuple(slice(start, start + size) for start, size in zip(offset, volumes['ct_ave'].shape))
+    cropped = offset[1] > 0 and offset[2] > 0 and volumes['ct_ave'].shape[1:] < ct[0].shape[1:]
+    calibration = load_calibration()
+    rsp = all(np.array_equal(volumes['ct_eval_rsp'][phase], calibration.convert(phase_ct)[box]) 
+              for phase, phase_ct in enumerate(ct))
+    aip = np.array_equal(volumes['ct_ave'], np.rint(sum(phase_ct.astype(np.float32) for phase_ct in ct) / len(ct))[box])
+    restored = uncrop_volume(volumes['ct_eval_rsp'], metadata).shape == (len(ct),) + ct[0].shape
+    return bool(cropped and files and rsp and aip and restored)
@@ -0,0 +1,30 @@
+"""
+@author: Kyriakos Fotiou
+"""
+import matplotlib
+# Benchmarks never plot, a non-interactive backend keeps them runnable on headless machines
+matplotlib.use('Agg')
+from Functions_Benchmarks import run_benchmarks, write_benchmark_results
+
+if __name__ == '__main__':
+    """
+    Stage Benchmarks
+    """
+    ## Synthetic breathing phantom: (Z, Y, X) grid size, number of phases, tumour radius and
+    ## superior-inferior motion amplitude in mm
+    shape = (40, 128, 128)
+    phases = 10
+    tumor_radius = 15
+    amplitude = 10
+    voxel_size = (3.0, 1.0527, 1.0527)
+    ## Number of timed runs of every stage; the best run gives the throughput
+    repeat = 3
+    ## Results are written as JSON so runs can be compared as the stages are rewritten
+    output = 'benchmark_results.json'
+
+    results = run_benchmarks(shape, phases, tumor_radius, amplitude, voxel_size, repeat=repeat)
+    write_benchmark_results(results, output)
+    print('{:<36}{:>12}{:>22}{:>14}'.format('stage', 'seconds', 'throughput', 'peak MB'))
+    for stage, result in results['stages'].items():
+        print('{:<36}{:>12.4f}{:>14.3g} {:<7}{:>14.1f}'.format(stage, result['seconds'], result['throughput'],
+                                                           result['unit'].split()[-1] + '/s', result['peak_memory_mb']))
@@ -0,0 +1,50 @@
+"""
+@author: Kyriakos Fotiou
+"""
+import matplotlib
+# Validation never plots, a non-interactive backend keeps it runnable on headless machines
+matplotlib.use('Agg')
+from Functions_Benchmarks import generate_phantom
+import numpy as np
+from Functions_Validation import (check_distal_edge_parity, check_lines_parity, check_triplet_parity, find_optimal_triplet, 
+                                  check_container_crop)
+from Functions_Pre_Processing import union_masks
+from Functions_Angle_Selection import generate_steps, get_distal_edge_point, generate_geometries
+
+if __name__ == '__main__':
+    """
+    Engine Validation
+    """
+    ## The original implementations loop over every voxel in Python, so the phantom is kept small
+    shape = (20, 64, 64)
+    phases = 4
+    tumor_radius = 8
+    geometries = [(0, 0), (0, 90), (30, 40), (-60, 130), (90, 270), (15, 170)]
+    ## The reference triplet search is cubic in the candidates, so it runs on random subsets of the grid
+    triplet_trials = 30
+    triplet_candidates = 30
+    ## On the full grid the combination search is compared with the vectorised triplet search
+    grid_trials = 5
+
+    phantom = generate_phantom(shape, phases, tumor_radius)
+    tumor = union_masks(phantom['tumor']).astype(int)
+    results = {}
+    for couch_angle, gantry_angle in geometries:
+        steps = generate_steps(gantry_angle, couch_angle, [0,-1,0])
+        results['distal edge {}/{}'.format(couch_angle, gantry_angle)] = check_distal_edge_parity(tumor, steps)
+        distal_points, distal_array = get_distal_edge_point(tumor, steps)
+        results['lines {}/{}'.format(couch_angle, gantry_angle)] = check_lines_parity(tumor, distal_points, steps)
+    grid = np.array(generate_geometries(), dtype=float)
+    rng = np.random.default_rng(0)
+    for trial in range(triplet_trials):
+        couch_angles, gantry_angles = grid[rng.choice(len(grid), triplet_candidates, replace=False)].T
+        z_scores = rng.normal(size=triplet_candidates)
+        results['triplet {}'.format(trial)] = check_triplet_parity(couch_angles, gantry_angles, z_scores)
+    couch_angles, gantry_angles = grid.T
+    for trial in range(grid_trials):
+        z_scores = rng.normal(size=len(grid))
+        results['triplet grid {}'.format(trial)] = check_triplet_parity(couch_angles, gantry_angles, z_scores, 
+                                                                        reference=find_optimal_triplet)
+    results['container crop'] = check_container_crop(phantom)
+    for check, parity in results.items():
+        print('{:<36}{}'.format(check, 'ok' if parity else 'MISMATCH'))